@@ -1,12 +1,18 @@
 #!/usr/bin/env python3
 import argparse
+import functools
+import hashlib
+import json
 import logging
 import os
+import re
 import shutil
 import socket
 import subprocess
 import sys
+import tempfile
 import test_framework
+import threading
 import time
 import traceback
 
@@ -39,6 +45,31 @@ REVAULTD_VERSION = os.getenv("REVAULTD_VERSION", "0.4.0")
 REVAULT_GUI_VERSION = os.getenv("REVAULT_GUI_VERSION", "0.4")
 WITH_GUI = os.getenv("WITH_GUI", "1") == "1"
 WITH_ALL_HWS = os.getenv("WITH_ALL_HWS", "0") == "1"
+# Build the GUI in the background once the shell is opened, instead of before deploying
+LAZY_GUI = os.getenv("LAZY_GUI", "1") == "1"
+WITH_BIN_CACHE = os.getenv("WITH_BIN_CACHE", "1") == "1"
+BIN_CACHE_DIR = os.getenv("BIN_CACHE_DIR", os.path.join(SRC_DIR, "bin_cache"))
+SNAPSHOTS_DIR = os.getenv("SNAPSHOTS_DIR", os.path.abspath("snapshots"))
+WITH_CHAIN_TEMPLATE = os.getenv("WITH_CHAIN_TEMPLATE", "1") == "1"
+CHAIN_TEMPLATES_DIR = os.getenv(
+    "CHAIN_TEMPLATES_DIR", os.path.join(SRC_DIR, "chain_templates")
+)
+# The maximum number of crates built concurrently, and of jobs per cargo invocation
+BUILD_WORKERS = int(os.getenv("BUILD_WORKERS", 5))
+CARGO_JOBS = os.getenv("CARGO_JOBS")
+# A target directory shared by all crates, so that common dependencies are only
+# compiled once. Note that cargo locks it while building.
+SHARED_TARGET_DIR = os.getenv("SHARED_TARGET_DIR")
+# A directory containing, for each repo, either a bare mirror ("revaultd.git") or a
+# bundle ("revaultd.bundle") to fetch from instead of the network.
+GIT_MIRRORS_DIR = os.getenv("GIT_MIRRORS_DIR")
+# Only fetch the requested version, without its history
+SHALLOW_FETCH = os.getenv("SHALLOW_FETCH", "0") == "1"
+# Don't fetch at all if the requested version is already known locally
+LAZY_FETCH = os.getenv("LAZY_FETCH", "0") == "1"
+
+# Protects the binary cache's refs index
+bin_cache_lock = threading.Lock()
 
 
 # FIXME: use tmp
@@ -62,81 +93,460 @@ def is_listening(host, port):
         return False
 
 
-def build_src(src_dir, version, git_url):
+# The files rustup reads the toolchain of a crate from
+TOOLCHAIN_FILES = ["rust-toolchain", "rust-toolchain.toml"]
+
+
+def toolchain_file(src_dir):
+    """Get the (name, content) of the toolchain file at the root of the checkout at
+    {src_dir}, or None if it has none."""
+    for name in TOOLCHAIN_FILES:
+        path = os.path.join(src_dir, name)
+        if os.path.isfile(path):
+            with open(path) as f:
+                return (name, f.read())
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def toolchain_version(toolchain):
+    """Get the version of the Rust compiler rustup resolves for this {toolchain} file
+    (as returned by toolchain_file())."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if toolchain is not None:
+            (name, content) = toolchain
+            with open(os.path.join(tmp_dir, name), "w") as f:
+                f.write(content)
+        return (
+            subprocess.check_output(["rustc", "--version"], cwd=tmp_dir)
+            .decode()
+            .strip()
+        )
+
+
+def bin_cache_entry(toolchain, git_url, commit, profile):
+    """Get the directory of the binary cache entry for this build."""
+    key = "\n".join([git_url, commit, profile, toolchain_version(toolchain)])
+    return os.path.join(BIN_CACHE_DIR, hashlib.sha256(key.encode()).hexdigest())
+
+
+def bin_cache_refs_file():
+    return os.path.join(BIN_CACHE_DIR, "refs.json")
+
+
+def cached_ref(git_url, version):
+    """Get the commit a pinned (tag or commit hash) {version} resolved to when we
+    last built it, along with its toolchain file, if any."""
+    try:
+        with open(bin_cache_refs_file(), "r") as f:
+            ref = json.load(f).get(f"{git_url}#{version}")
+    except FileNotFoundError:
+        return None
+    # Entries from before we recorded the toolchain file are ignored
+    if not isinstance(ref, dict):
+        return None
+    toolchain = ref["toolchain"]
+    return ref["commit"], tuple(toolchain) if toolchain is not None else None
+
+
+def cache_ref(git_url, version, commit, toolchain):
+    """Remember the commit a pinned {version} resolves to, and the toolchain file
+    at this commit, so that we don't have to go through git next time."""
+    with bin_cache_lock:
+        os.makedirs(BIN_CACHE_DIR, exist_ok=True)
+        try:
+            with open(bin_cache_refs_file(), "r") as f:
+                refs = json.load(f)
+        except FileNotFoundError:
+            refs = {}
+        refs[f"{git_url}#{version}"] = {"commit": commit, "toolchain": toolchain}
+        tmp_file = f"{bin_cache_refs_file()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(refs, f, indent=4)
+        os.replace(tmp_file, bin_cache_refs_file())
+
+
+def cached_binaries(entry_dir, binaries):
+    """Get the paths to all the {binaries} in this cache entry, or None if
+    it's incomplete."""
+    if not os.path.isfile(os.path.join(entry_dir, "manifest.json")):
+        return None
+    bins = {name: os.path.join(entry_dir, name) for name in binaries}
+    if not all(os.path.isfile(path) for path in bins.values()):
+        return None
+    return bins
+
+
+def cache_binaries(entry_dir, bins, manifest):
+    """Copy the built binaries to this cache entry and return their new paths."""
+    tmp_dir = f"{entry_dir}.tmp-{os.getpid()}-{threading.get_ident()}"
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    for name, path in bins.items():
+        shutil.copy2(path, os.path.join(tmp_dir, name))
+    # The manifest is what marks the entry as complete
+    with open(os.path.join(tmp_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=4)
+    if os.path.isdir(entry_dir):
+        shutil.rmtree(entry_dir)
+    os.rename(tmp_dir, entry_dir)
+    return cached_binaries(entry_dir, bins)
+
+
+def cargo_profile_args(profile):
+    """Get the cargo build arguments to build with this profile."""
+    if profile == "debug":
+        return []
+    if profile == "release":
+        return ["--release"]
+    return ["--profile", profile]
+
+
+def cargo_profile_dir(profile):
+    """Get the name of the directory in which cargo outputs this profile's artifacts."""
+    return "debug" if profile in ["debug", "dev"] else profile
+
+
+def is_pinned(src_dir, version):
+    """Whether {version} is a tag or a commit hash, as opposed to a branch."""
+    if re.fullmatch(r"[0-9a-f]{40}", version) is not None:
+        return True
+    cmd = ["git", "-C", f"{src_dir}", "rev-parse", "--verify", "--quiet"]
+    return (
+        subprocess.call(cmd + [f"refs/tags/{version}"], stdout=subprocess.DEVNULL) == 0
+    )
+
+
+def git_source(git_url):
+    """Get the location to fetch the repo at {git_url} from. This is its local
+    mirror or bundle if there is one in GIT_MIRRORS_DIR, the url itself otherwise."""
+    if GIT_MIRRORS_DIR is None:
+        return git_url
+
+    name = os.path.basename(git_url.rstrip("/"))
+    if name.endswith(".git"):
+        name = name[: -len(".git")]
+    for candidate in [f"{name}.bundle", f"{name}.git", name]:
+        path = os.path.join(GIT_MIRRORS_DIR, candidate)
+        if os.path.exists(path):
+            return path
+
+    logging.warning(f"No mirror for '{name}' in '{GIT_MIRRORS_DIR}', using '{git_url}'")
+    return git_url
+
+
+def resolve_version(src_dir, version):
+    """Get the commit {version} points to in this local clone, or None if it
+    doesn't know about it. Tags take precedence over branches."""
+    cmd = ["git", "-C", f"{src_dir}", "rev-parse", "--verify", "--quiet"]
+    for ref in [f"refs/tags/{version}", f"refs/remotes/origin/{version}", version]:
+        try:
+            return subprocess.check_output(cmd + [f"{ref}^{{commit}}"]).decode().strip()
+        except subprocess.CalledProcessError:
+            continue
+    return None
+
+
+def fetch_version(src_dir, version, source, output=None):
+    """Fetch {version} from {source}.
+
+    By default fetch all tags and branches, but only the requested ref without its
+    history if SHALLOW_FETCH is set.
+    """
+    if not SHALLOW_FETCH:
+        subprocess.check_call(
+            ["git", "-C", f"{src_dir}", "fetch", "--tags", source]
+            + ["+refs/heads/*:refs/remotes/origin/*"],
+            stdout=output,
+            stderr=output,
+        )
+        return
+
+    # Bundles can't be fetched from partially
+    depth = [] if source.endswith(".bundle") else ["--depth", "1"]
+    # We don't know whether it's a tag, a branch or a commit hash: try in this order.
+    for refspec in [
+        f"+refs/tags/{version}:refs/tags/{version}",
+        f"+refs/heads/{version}:refs/remotes/origin/{version}",
+        version,
+    ]:
+        cmd = ["git", "-C", f"{src_dir}", "fetch", "--no-tags"] + depth
+        if (
+            subprocess.call(
+                cmd + [source, refspec], stdout=output, stderr=subprocess.DEVNULL
+            )
+            == 0
+        ):
+            return
+    raise ValueError(f"Could not fetch '{version}' from '{source}'")
+
+
+def checkout_src(src_dir, version, git_url, output=None):
+    """Checkout {version} of the repo at {git_url} in {src_dir}, cloning it if
+    necessary. Returns the commit that was checked out."""
+    source = git_source(git_url)
+
     if not os.path.isdir(src_dir):
-        if not os.path.isdir(SRC_DIR):
-            os.makedirs(SRC_DIR)
-        subprocess.check_call(["git", "-C", f"{SRC_DIR}", "clone", git_url])
+        os.makedirs(SRC_DIR, exist_ok=True)
+        if SHALLOW_FETCH:
+            subprocess.check_call(
+                ["git", "init", "--quiet", f"{src_dir}"], stdout=output, stderr=output
+            )
+            subprocess.check_call(
+                ["git", "-C", f"{src_dir}", "remote", "add", "origin", source],
+                stdout=output,
+                stderr=output,
+            )
+        else:
+            subprocess.check_call(
+                ["git", "clone", source, f"{src_dir}"], stdout=output, stderr=output
+            )
+
+    commit = resolve_version(src_dir, version) if LAZY_FETCH else None
+    if commit is None:
+        fetch_version(src_dir, version, source, output)
+        commit = resolve_version(src_dir, version)
+        if commit is None:
+            raise ValueError(f"Unknown version '{version}' for '{git_url}'")
+    else:
+        logging.info(f"'{version}' is known locally, not fetching '{source}'")
 
-    subprocess.check_call(["git", "-C", f"{src_dir}", "fetch", "origin"])
-    subprocess.check_call(["git", "-C", f"{src_dir}", "checkout", f"{version}"])
     subprocess.check_call(
-        ["cargo", "build", "--manifest-path", f"{src_dir}/Cargo.toml"]
+        ["git", "-C", f"{src_dir}", "checkout", "--quiet", "--detach", commit],
+        stdout=output,
+        stderr=output,
     )
+    return commit
 
 
-def build_all_binaries(build_cosig, build_wt, build_coordinator=True):
-    if build_coordinator:
-        logging.info(
-            f"Building coordinatord at '{COORDINATORD_VERSION}' in '{COORDINATORD_SRC_DIR}'"
+def build_src(src_dir, version, git_url, binaries, profile="debug", output=None):
+    """Build the repo at {git_url} at {version} and get the path to its {binaries}.
+
+    {binaries} is a mapping from the name of a binary to the directory of the crate
+    building it, relative to the root of the repo. If we already built this version
+    with the same toolchain the binaries are taken from the cache, without going
+    through git or cargo if the version is pinned.
+    {profile} is either "debug", "release" or the name of a custom Cargo profile.
+    The output of git and cargo is redirected to the {output} file, if given.
+    """
+
+    if WITH_BIN_CACHE:
+        ref = cached_ref(git_url, version)
+        if ref is not None:
+            (commit, toolchain) = ref
+            entry_dir = bin_cache_entry(toolchain, git_url, commit, profile)
+            bins = cached_binaries(entry_dir, binaries)
+            if bins is not None:
+                logging.info(f"Using cached binaries for '{git_url}' at '{version}'")
+                return bins
+
+    commit = checkout_src(src_dir, version, git_url, output)
+    # The toolchain may be pinned by the checked out commit
+    toolchain = toolchain_file(src_dir)
+
+    if WITH_BIN_CACHE:
+        if is_pinned(src_dir, version):
+            cache_ref(git_url, version, commit, toolchain)
+        entry_dir = bin_cache_entry(toolchain, git_url, commit, profile)
+        bins = cached_binaries(entry_dir, binaries)
+        if bins is not None:
+            logging.info(f"Using cached binaries for '{git_url}' at '{commit}'")
+            return bins
+
+    cargo_env = os.environ.copy()
+    if SHARED_TARGET_DIR is not None:
+        cargo_env["CARGO_TARGET_DIR"] = SHARED_TARGET_DIR
+    for crate_dir in sorted(set(binaries.values())):
+        cmd = [
+            "cargo",
+            "build",
+            "--manifest-path",
+            os.path.join(src_dir, crate_dir, "Cargo.toml"),
+        ] + cargo_profile_args(profile)
+        if CARGO_JOBS is not None:
+            cmd += ["-j", CARGO_JOBS]
+        subprocess.check_call(cmd, env=cargo_env, stdout=output, stderr=output)
+    bins = {
+        name: os.path.join(
+            SHARED_TARGET_DIR or os.path.join(src_dir, crate_dir, "target"),
+            cargo_profile_dir(profile),
+            name,
         )
-        build_src(
-            COORDINATORD_SRC_DIR,
-            COORDINATORD_VERSION,
-            "https://github.com/revault/coordinatord",
+        for name, crate_dir in binaries.items()
+    }
+
+    if WITH_BIN_CACHE:
+        manifest = {
+            "git_url": git_url,
+            "version": version,
+            "commit": commit,
+            "profile": profile,
+            "toolchain": toolchain_version(toolchain),
+        }
+        bins = cache_binaries(entry_dir, bins, manifest)
+    return bins
+
+
+# The build_src arguments for revault-gui and its dummysigner
+GUI_BUILD_ARGS = (
+    REVAULT_GUI_SRC_DIR,
+    "https://github.com/edouardparis/revault-gui",
+    {
+        "revault-gui": "",
+        "dummysigner": os.path.join("contrib", "tools", "dummysigner"),
+    },
+)
+
+
+def start_gui_build(bin_dir, log_file, profile="debug"):
+    """Build revault-gui and its dummysigner in a background thread.
+
+    Once built, the binaries are linked into {bin_dir}. If the build fails a
+    'gui_build_failed' file is created there instead. The output of the build goes
+    to {log_file}.
+    """
+    os.makedirs(bin_dir, exist_ok=True)
+    # The bin directory may come from a previous session (eg a restored snapshot)
+    for name in list(GUI_BUILD_ARGS[2]) + ["gui_build_failed"]:
+        path = os.path.join(bin_dir, name)
+        if os.path.lexists(path):
+            os.remove(path)
+
+    def build():
+        with open(log_file, "w") as output:
+            try:
+                (src_dir, git_url, binaries) = GUI_BUILD_ARGS
+                bins = build_src(
+                    src_dir, REVAULT_GUI_VERSION, git_url, binaries, profile, output
+                )
+            except Exception as e:
+                output.write(f"Error building revault-gui: '{str(e)}'\n")
+                output.write(traceback.format_exc())
+                open(os.path.join(bin_dir, "gui_build_failed"), "w").close()
+                return
+        for name, path in bins.items():
+            os.symlink(path, os.path.join(bin_dir, name))
+
+    thread = threading.Thread(target=build, name="revault-gui-build", daemon=True)
+    thread.start()
+    return thread
+
+
+def timed_build(name, *args):
+    """Run build_src, returning the built binaries along with the time it took."""
+    start = time.monotonic()
+    bins = build_src(*args)
+    elapsed = time.monotonic() - start
+    logging.info(f"Got {name} in {elapsed:.1f}s")
+    return bins, elapsed
+
+
+def build_all_binaries(build_cosig, build_wt, build_coordinator=True, profile="debug"):
+    """Build all the binaries necessary for this deployment.
+
+    The repositories are fetched and built concurrently, using up to BUILD_WORKERS
+    threads. All the crates of a single repository are built by the same job as
+    they share its checkout.
+    Returns a mapping from the name of each binary to its path.
+    """
+    # The name of the job, the version to build, and the build_src arguments
+    jobs = []
+
+    if build_coordinator:
+        jobs.append(
+            (
+                "coordinatord",
+                COORDINATORD_VERSION,
+                COORDINATORD_SRC_DIR,
+                "https://github.com/revault/coordinatord",
+                {"coordinatord": ""},
+            )
         )
     else:
         logging.info("Skipping the build of the coordinator, using the dummy one.")
 
     if build_cosig:
-        logging.info(
-            f"Building cosignerd at '{COSIGNERD_VERSION}' in '{COSIGNERD_SRC_DIR}'"
-        )
-        build_src(
-            COSIGNERD_SRC_DIR, COSIGNERD_VERSION, "https://github.com/revault/cosignerd"
+        jobs.append(
+            (
+                "cosignerd",
+                COSIGNERD_VERSION,
+                COSIGNERD_SRC_DIR,
+                "https://github.com/revault/cosignerd",
+                {"cosignerd": ""},
+            )
         )
 
     if build_wt:
-        logging.info(
-            f"Building miradord at '{MIRADORD_VERSION}' in '{MIRADORD_SRC_DIR}'"
+        jobs.append(
+            (
+                "miradord",
+                MIRADORD_VERSION,
+                MIRADORD_SRC_DIR,
+                "https://github.com/revault/miradord",
+                {"miradord": ""},
+            )
         )
-        build_src(
-            MIRADORD_SRC_DIR, MIRADORD_VERSION, "https://github.com/revault/miradord"
+
+    jobs.append(
+        (
+            "revaultd",
+            REVAULTD_VERSION,
+            REVAULTD_SRC_DIR,
+            "https://github.com/revault/revaultd",
+            {"revaultd": "", "revault-cli": ""},
         )
+    )
 
-    logging.info(f"Building revaultd at '{REVAULTD_VERSION}' in '{REVAULTD_SRC_DIR}'")
-    build_src(REVAULTD_SRC_DIR, REVAULTD_VERSION, "https://github.com/revault/revaultd")
+    if WITH_GUI and not LAZY_GUI:
+        logging.info("Building revault-gui and its dummysigner, this may take some time")
+        jobs.append(("revault-gui", REVAULT_GUI_VERSION) + GUI_BUILD_ARGS)
 
-    if WITH_GUI:
-        logging.info(
-            f"Building revault-gui at '{REVAULT_GUI_VERSION}' in '{REVAULT_GUI_SRC_DIR}',"
-            " this may take some time"
-        )
-        build_src(
-            REVAULT_GUI_SRC_DIR,
-            REVAULT_GUI_VERSION,
-            "https://github.com/edouardparis/revault-gui",
-        )
+    bins, timings = {}, {}
+    with futures.ThreadPoolExecutor(
+        max_workers=BUILD_WORKERS, thread_name_prefix="revault-build"
+    ) as build_executor:
+        build_jobs = {}
+        for (name, version, src_dir, git_url, binaries) in jobs:
+            logging.info(f"Building {name} at '{version}' in '{src_dir}'")
+            build_jobs[name] = build_executor.submit(
+                timed_build, name, src_dir, version, git_url, binaries, profile
+            )
+        for name, job in build_jobs.items():
+            (job_bins, timings[name]) = job.result()
+            bins.update(job_bins)
 
-        logging.info("Building revault-gui's dummysigner")
-        subprocess.check_call(
-            [
-                "cargo",
-                "build",
-                "--manifest-path",
-                f"{REVAULT_GUI_SRC_DIR}/contrib/tools/dummysigner/Cargo.toml",
-            ]
-        )
+    logging.info(
+        "Build times: "
+        + ", ".join(f"{name} {elapsed:.1f}s" for name, elapsed in timings.items())
+    )
+    return bins
 
 
 def bitcoind():
-    bitcoind = BitcoinD(bitcoin_dir=bitcoind_dir())
+    bitcoind = BitcoinD(
+        bitcoin_dir=bitcoind_dir(),
+        chain_templates_dir=CHAIN_TEMPLATES_DIR if WITH_CHAIN_TEMPLATE else None,
+    )
     bitcoind.startup()
 
-    bitcoind.rpc.createwallet(bitcoind.rpc.wallet_name, False, False, "", False, True)
-
-    while bitcoind.rpc.getbalance() < 50:
-        bitcoind.rpc.generatetoaddress(1, bitcoind.rpc.getnewaddress())
+    if bitcoind.from_template:
+        # The funded wallet is loaded on startup. Mine a block to get out of IBD, as
+        # the template's tip is likely too old.
+        bitcoind.generate_block(1)
+    else:
+        bitcoind.rpc.createwallet(
+            bitcoind.rpc.wallet_name, False, False, "", False, True, True
+        )
+        # Coinbase outputs need 100 confirmations to be spendable. Go through
+        # generate_block() for the mocked time to advance with the blocks.
+        bitcoind.generate_block(101)
+        while bitcoind.rpc.getbalance() < 50:
+            bitcoind.generate_block(1)
+        if WITH_CHAIN_TEMPLATE:
+            logging.info(f"Saving the funded chain as a template in '{CHAIN_TEMPLATES_DIR}'")
+            os.makedirs(CHAIN_TEMPLATES_DIR, exist_ok=True)
+            bitcoind.save_chain_template()
 
     while bitcoind.rpc.getblockcount() <= 1:
         time.sleep(0.1)
@@ -144,13 +554,178 @@ def bitcoind():
     return bitcoind
 
 
+def check_base_dir():
+    """Make sure we start from an empty BASE_DIR, asking before removing it."""
+    if os.path.isdir(BASE_DIR):
+        logging.warning("Base directory exists already")
+        resp = input(f"Remove non-empty '{BASE_DIR}' and start fresh? (y/n) ")
+        if resp.lower() == "y":
+            shutil.rmtree(BASE_DIR)
+        else:
+            logging.info("Exiting")
+            sys.exit(1)
+
+
+def use_binaries(bins):
+    """Monkey patch the servers binaries paths"""
+    test_framework.revaultd.REVAULTD_PATH = bins["revaultd"]
+    if "coordinatord" in bins:
+        test_framework.coordinatord.COORDINATORD_PATH = bins["coordinatord"]
+    if "cosignerd" in bins:
+        test_framework.cosignerd.COSIGNERD_PATH = bins["cosignerd"]
+    if "miradord" in bins:
+        test_framework.miradord.MIRADORD_PATH = bins["miradord"]
+
+
+def daemons_versions():
+    return {
+        "cosignerd": COSIGNERD_VERSION,
+        "miradord": MIRADORD_VERSION,
+        "revaultd": REVAULTD_VERSION,
+    }
+
+
+def snapshot_path(name):
+    return os.path.join(SNAPSHOTS_DIR, f"{name}.tar")
+
+
+def manifest_path():
+    return os.path.join(BASE_DIR, "manifest.json")
+
+
+def write_manifest(rn):
+    """Write the manifest of this deployment to BASE_DIR, from which it can be
+    attached to (see RevaultNetwork.attach()) or restored."""
+    manifest = rn.manifest()
+    manifest["versions"] = daemons_versions()
+    with open(manifest_path(), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def save_snapshot(name):
+    """Archive the stopped deployment in BASE_DIR, manifest included."""
+    os.makedirs(SNAPSHOTS_DIR, exist_ok=True)
+    logging.info(f"Saving a snapshot of the deployment to '{snapshot_path(name)}'")
+    # Write it under a temporary name for a partial archive to never be restored
+    tmp_archive = shutil.make_archive(
+        os.path.join(SNAPSHOTS_DIR, f".{name}"), "tar", BASE_DIR
+    )
+    os.replace(tmp_archive, snapshot_path(name))
+
+
+def restore(name, profile="debug", snapshot=None, session=None):
+    """Restore the deployment saved in the snapshot {name}.
+
+    The daemons reuse their datadirs from the snapshot but listen on newly
+    reserved ports. If {snapshot} is set, the deployment is saved again under
+    this name when exiting the shell. See deploy() for {session}.
+    """
+    archive = snapshot_path(name)
+    if not os.path.isfile(archive):
+        logging.error(f"No snapshot at '{archive}'")
+        sys.exit(1)
+    if POSTGRES_IS_SETUP:
+        logging.error("Snapshots are only supported with the dummy coordinator")
+        sys.exit(1)
+
+    check_base_dir()
+    logging.info(f"Extracting snapshot '{archive}' to '{BASE_DIR}'")
+    shutil.unpack_archive(archive, BASE_DIR, "tar")
+    with open(manifest_path()) as f:
+        manifest = json.load(f)
+
+    current_versions = daemons_versions()
+    for daemon, version in manifest["versions"].items():
+        if current_versions[daemon] != version:
+            logging.warning(
+                f"The snapshot was taken with {daemon} '{version}' but"
+                f" '{current_versions[daemon]}' is going to be used."
+            )
+
+    layout = manifest["layout"]
+    logging.info("Checking the source directories..")
+    bins = build_all_binaries(
+        build_cosig=layout["with_cosigs"],
+        build_wt=layout["with_watchtowers"],
+        build_coordinator=False,
+        profile=profile,
+    )
+    use_binaries(bins)
+
+    logging.info("Starting bitcoind")
+    bd = BitcoinD(bitcoin_dir=bitcoind_dir())
+    bd.startup()
+    # The snapshot's tip may be too old for bitcoind to consider itself synced
+    if bd.rpc.getblockchaininfo()["initialblockdownload"]:
+        bd.generate_block(1)
+    snapshot_ready = False
+
+    # In any case cleanup bitcoind before exiting
+    try:
+        logging.info(
+            f"Restoring a Revault network with {len(layout['stakeholders'])}"
+            f" only-stakeholders, {len(layout['managers'])} only-managers,"
+            f" {len(layout['stkmanagers'])} both stakeholders and managers and a CSV"
+            f" of {manifest['csv']}"
+        )
+        rn = RevaultNetwork(
+            BASE_DIR,
+            bd,
+            executor(),
+            POSTGRES_USER,
+            POSTGRES_PASS,
+            POSTGRES_HOST,
+        )
+        rn.restore(manifest)
+        write_manifest(rn)
+
+        # In any case clean up all daemons before exiting
+        try:
+            (session or run_shell)(rn, bd, bins, profile)
+        finally:
+            logging.info("Cleaning up Revault deployment")
+            rn.cleanup()
+        if snapshot is not None:
+            write_manifest(rn)
+            snapshot_ready = True
+    except Exception as e:
+        logging.error(f"Got error: '{str(e)}'")
+        logging.error(traceback.format_exc())
+        # Only the interactive shell carries on, a failed session must not look
+        # like a successful run to the caller. bitcoind is still cleaned up.
+        if session is not None:
+            sys.exit(1)
+    finally:
+        logging.info("Cleaning up bitcoind")
+        bd.cleanup()
+
+    if snapshot_ready:
+        save_snapshot(snapshot)
+
+
 def deploy(
-    n_stks, n_mans, n_stkmans, csv, mans_thresh=None, with_cosigs=False, policies=[]
+    n_stks,
+    n_mans,
+    n_stkmans,
+    csv,
+    mans_thresh=None,
+    with_cosigs=False,
+    policies=[],
+    profile="debug",
+    snapshot=None,
+    session=None,
 ):
+    """Deploy a new Revault network and run the {session} against it, by default
+    run_shell(). It is called with the RevaultNetwork, the BitcoinD, the binaries
+    and the build profile. If a {session} other than the shell fails, the process
+    exits with a non-zero status once everything is cleaned up."""
     with_wts = len(policies) > 0
 
     if not POSTGRES_IS_SETUP:
         logging.info("No Postgre backend given, will use a dummy coordinator")
+    elif snapshot is not None:
+        logging.error("Snapshots are only supported with the dummy coordinator")
+        sys.exit(1)
 
     if POSTGRES_IS_SETUP and not is_listening(POSTGRES_HOST, 5432):
         logging.error(f"No Postgre server listening on {POSTGRES_HOST}:5432.")
@@ -179,20 +754,19 @@ def deploy(
             logging.error(f"No plugin at '{p}'")
             sys.exit(1)
 
-    if os.path.isdir(BASE_DIR):
-        logging.warning("Base directory exists already")
-        resp = input(f"Remove non-empty '{BASE_DIR}' and start fresh? (y/n) ")
-        if resp.lower() == "y":
-            shutil.rmtree(BASE_DIR)
-        else:
-            logging.info("Exiting")
-            sys.exit(1)
+    check_base_dir()
 
     logging.info("Checking the source directories..")
-    build_all_binaries(build_cosig=with_cosigs, build_wt=with_wts, build_coordinator=POSTGRES_IS_SETUP)
+    bins = build_all_binaries(
+        build_cosig=with_cosigs,
+        build_wt=with_wts,
+        build_coordinator=POSTGRES_IS_SETUP,
+        profile=profile,
+    )
 
     logging.info("Setting up bitcoind")
     bd = bitcoind()
+    snapshot_ready = False
 
     # In any case cleanup bitcoind before exiting
     try:
@@ -201,19 +775,7 @@ def deploy(
             f" {n_mans} only-managers, {n_stkmans} both stakeholders and managers,"
             f" a CSV of {csv} and a managers threshold of {mans_thresh or n_mans + n_stkmans}"
         )
-        # Monkey patch the servers binaries paths
-        test_framework.revaultd.REVAULTD_PATH = os.path.join(
-            REVAULTD_SRC_DIR, "target", "debug", "revaultd"
-        )
-        test_framework.coordinatord.COORDINATORD_PATH = os.path.join(
-            COORDINATORD_SRC_DIR, "target", "debug", "coordinatord"
-        )
-        test_framework.cosignerd.COSIGNERD_PATH = os.path.join(
-            COSIGNERD_SRC_DIR, "target", "debug", "cosignerd"
-        )
-        test_framework.miradord.MIRADORD_PATH = os.path.join(
-            MIRADORD_SRC_DIR, "target", "debug", "miradord"
-        )
+        use_binaries(bins)
         rn = RevaultNetwork(
             BASE_DIR,
             bd,
@@ -237,129 +799,311 @@ def deploy(
             policies = [{"path": p} for p in policies]
             for stk in rn.stk_wallets + rn.stkman_wallets:
                 stk.watchtower.add_plugins(policies)
+        write_manifest(rn)
 
-        dummysigner_conf_file = os.path.join(BASE_DIR, "dummysigner.toml")
-        # We use a hack to avoid having to modify the test_framework to include the GUI.
-        if WITH_GUI:
-            emergency_address = rn.emergency_address
-            deposit_desc = rn.deposit_desc
-            unvault_desc = rn.unvault_desc
-            cpfp_desc = rn.cpfp_desc
-            with open(dummysigner_conf_file, "w") as f:
-                f.write(f'emergency_address = "{emergency_address}"\n')
-                for i, stk in enumerate(rn.stk_wallets):
-                    f.write("[[keys]]\n")
-                    f.write(f'name = "stakeholder_{i}_key"\n')
-                    f.write(f'xpriv = "{stk.stk_keychain.hd.get_xpriv()}"\n')
-                for i, man in enumerate(rn.man_wallets):
-                    f.write("[[keys]]\n")
-                    f.write(f'name = "manager_{i}_key"\n')
-                    f.write(f'xpriv = "{man.man_keychain.hd.get_xpriv()}"\n')
-                for i, stkman in enumerate(rn.stkman_wallets):
-                    f.write("[[keys]]\n")
-                    f.write(f'name = "stkman_{i}_stakeholder_key"\n')
-                    f.write(f'xpriv = "{stkman.stk_keychain.hd.get_xpriv()}"\n')
-                    f.write("[[keys]]\n")
-                    f.write(f'name = "stkman_{i}_manager_key"\n')
-                    f.write(f'xpriv = "{stkman.man_keychain.hd.get_xpriv()}"\n')
-                f.write("[descriptors]\n")
-                f.write(f'deposit_descriptor = "{deposit_desc}"\n')
-                f.write(f'unvault_descriptor = "{unvault_desc}"\n')
-                f.write(f'cpfp_descriptor = "{cpfp_desc}"\n')
-
-            for p in rn.participants():
-                p.gui_conf_file = os.path.join(
-                    p.datadir_with_network, "gui_config.toml"
-                )
-                with open(p.gui_conf_file, "w") as f:
-                    f.write(f"revaultd_config_path = '{p.conf_file}'\n")
-                    f.write(f"revaultd_path = '{test_framework.revaultd.REVAULTD_PATH}'\n")
-                    f.write(f"log_level = '{LOG_LEVEL}'\n")
-                    f.write(f"debug = {'true' if DEBUG_GUI else 'false'}")
-            revault_gui = os.path.join(
-                REVAULT_GUI_SRC_DIR, "target", "debug", "revault-gui"
-            )
-            dummysigner = os.path.join(
-                REVAULT_GUI_SRC_DIR,
-                "contrib",
-                "tools",
-                "dummysigner",
-                "target",
-                "debug",
-                "dummysigner",
+        # In any case clean up all daemons before exiting
+        try:
+            (session or run_shell)(rn, bd, bins, profile)
+        finally:
+            logging.info("Cleaning up Revault deployment")
+            rn.cleanup()
+        if snapshot is not None:
+            write_manifest(rn)
+            snapshot_ready = True
+    except Exception as e:
+        logging.error(f"Got error: '{str(e)}'")
+        logging.error(traceback.format_exc())
+        # Only the interactive shell carries on, a failed session must not look
+        # like a successful run to the caller. bitcoind is still cleaned up.
+        if session is not None:
+            sys.exit(1)
+    finally:
+        logging.info("Cleaning up bitcoind")
+        bd.cleanup()
+
+    if snapshot_ready:
+        save_snapshot(snapshot)
+
+
+def run_shell(rn, bd, bins, profile="debug"):
+    """Write the GUI configurations and the aliases for this deployment, and drop
+    the user into a shell from which to interact with it."""
+    dummysigner_conf_file = os.path.join(BASE_DIR, "dummysigner.toml")
+    # We use a hack to avoid having to modify the test_framework to include the GUI.
+    if WITH_GUI:
+        emergency_address = rn.emergency_address
+        deposit_desc = rn.deposit_desc
+        unvault_desc = rn.unvault_desc
+        cpfp_desc = rn.cpfp_desc
+        with open(dummysigner_conf_file, "w") as f:
+            f.write(f'emergency_address = "{emergency_address}"\n')
+            for i, stk in enumerate(rn.stk_wallets):
+                f.write("[[keys]]\n")
+                f.write(f'name = "stakeholder_{i}_key"\n')
+                f.write(f'xpriv = "{stk.stk_keychain.hd.get_xpriv()}"\n')
+            for i, man in enumerate(rn.man_wallets):
+                f.write("[[keys]]\n")
+                f.write(f'name = "manager_{i}_key"\n')
+                f.write(f'xpriv = "{man.man_keychain.hd.get_xpriv()}"\n')
+            for i, stkman in enumerate(rn.stkman_wallets):
+                f.write("[[keys]]\n")
+                f.write(f'name = "stkman_{i}_stakeholder_key"\n')
+                f.write(f'xpriv = "{stkman.stk_keychain.hd.get_xpriv()}"\n')
+                f.write("[[keys]]\n")
+                f.write(f'name = "stkman_{i}_manager_key"\n')
+                f.write(f'xpriv = "{stkman.man_keychain.hd.get_xpriv()}"\n')
+            f.write("[descriptors]\n")
+            f.write(f'deposit_descriptor = "{deposit_desc}"\n')
+            f.write(f'unvault_descriptor = "{unvault_desc}"\n')
+            f.write(f'cpfp_descriptor = "{cpfp_desc}"\n')
+
+        for p in rn.participants():
+            p.gui_conf_file = os.path.join(
+                p.datadir_with_network, "gui_config.toml"
             )
+            with open(p.gui_conf_file, "w") as f:
+                f.write(f"revaultd_config_path = '{p.conf_file}'\n")
+                f.write(f"revaultd_path = '{test_framework.revaultd.REVAULTD_PATH}'\n")
+                f.write(f"log_level = '{LOG_LEVEL}'\n")
+                f.write(f"debug = {'true' if DEBUG_GUI else 'false'}")
+        if LAZY_GUI:
+            # The aliases wait for the background build to be done
+            gui_bin_dir = os.path.join(BASE_DIR, "bin")
+            gui_build_log = os.path.join(BASE_DIR, "gui_build.log")
+            revault_gui = f"wait_for_gui && {gui_bin_dir}/revault-gui"
+            dummysigner = f"wait_for_gui && {gui_bin_dir}/dummysigner"
+        else:
+            revault_gui = bins["revault-gui"]
+            dummysigner = bins["dummysigner"]
 
-        revault_cli = os.path.join(REVAULTD_SRC_DIR, "target", "debug", "revault-cli")
-        aliases_file = os.path.join(BASE_DIR, "aliases.sh")
-        with open(aliases_file, "w") as f:
-            f.write('PS1="(Revault demo) $PS1"\n')  # It's a hack it shouldn't be there
-            f.write(f"alias bd=\"bitcoind -datadir='{bd.bitcoin_dir}'\"\n")
+    revault_cli = bins["revault-cli"]
+    aliases_file = os.path.join(BASE_DIR, "aliases.sh")
+    with open(aliases_file, "w") as f:
+        f.write('PS1="(Revault demo) $PS1"\n')  # It's a hack it shouldn't be there
+        if WITH_GUI and LAZY_GUI:
             f.write(
-                f"alias bcli=\"bitcoin-cli -datadir='{bd.bitcoin_dir}' -rpcwallet='{bd.rpc.wallet_name}'\"\n"
+                "wait_for_gui() { "
+                f"while [ ! -e '{gui_bin_dir}/revault-gui' ] || [ ! -e '{gui_bin_dir}/dummysigner' ]; do "
+                f"if [ -e '{gui_bin_dir}/gui_build_failed' ]; then "
+                f"echo \"Failed to build revault-gui, see '{gui_build_log}'.\" >&2; return 1; fi; "
+                f"echo \"Waiting for revault-gui to be built (see '{gui_build_log}')..\" >&2; "
+                "sleep 5; done; }\n"
             )
-            for i, stk in enumerate(rn.stk_wallets):
-                f.write(f'alias stk{i}cli="{revault_cli} --conf {stk.conf_file}"\n')
-                f.write(f'alias stk{i}d="{test_framework.revaultd.REVAULTD_PATH} --conf {stk.conf_file}"\n')
-                if WITH_GUI:
-                    f.write(
-                        f"alias stk{i}gui='{revault_gui} --conf {stk.gui_conf_file} > /dev/null'\n"
-                    )
-                    if WITH_ALL_HWS:
-                        f.write(
-                            f"alias stk{i}hw='{dummysigner} {stk.stk_keychain.hd.get_xpriv()} > /dev/null'\n"
-                        )
-            for i, man in enumerate(rn.man_wallets):
-                f.write(f'alias man{i}cli="{revault_cli} --conf {man.conf_file}"\n')
-                f.write(f'alias man{i}d="{test_framework.revaultd.REVAULTD_PATH} --conf {man.conf_file}"\n')
-                if WITH_GUI:
+        f.write(f"alias bd=\"bitcoind -datadir='{bd.bitcoin_dir}'\"\n")
+        f.write(
+            f"alias bcli=\"bitcoin-cli -datadir='{bd.bitcoin_dir}' -rpcwallet='{bd.rpc.wallet_name}'\"\n"
+        )
+        for i, stk in enumerate(rn.stk_wallets):
+            f.write(f'alias stk{i}cli="{revault_cli} --conf {stk.conf_file}"\n')
+            f.write(f'alias stk{i}d="{test_framework.revaultd.REVAULTD_PATH} --conf {stk.conf_file}"\n')
+            if WITH_GUI:
+                f.write(
+                    f"alias stk{i}gui='{revault_gui} --conf {stk.gui_conf_file} > /dev/null'\n"
+                )
+                if WITH_ALL_HWS:
                     f.write(
-                        f"alias man{i}gui='{revault_gui} --conf {man.gui_conf_file} > /dev/null'\n"
+                        f"alias stk{i}hw='{dummysigner} {stk.stk_keychain.hd.get_xpriv()} > /dev/null'\n"
                     )
-                    if WITH_ALL_HWS:
-                        f.write(
-                            f"alias man{i}hw='{dummysigner} {man.man_keychain.hd.get_xpriv()} > /dev/null'\n"
-                        )
-            for i, stkman in enumerate(rn.stkman_wallets):
+        for i, man in enumerate(rn.man_wallets):
+            f.write(f'alias man{i}cli="{revault_cli} --conf {man.conf_file}"\n')
+            f.write(f'alias man{i}d="{test_framework.revaultd.REVAULTD_PATH} --conf {man.conf_file}"\n')
+            if WITH_GUI:
                 f.write(
-                    f'alias stkman{i}cli="{revault_cli} --conf {stkman.conf_file}"\n'
+                    f"alias man{i}gui='{revault_gui} --conf {man.gui_conf_file} > /dev/null'\n"
                 )
+                if WITH_ALL_HWS:
+                    f.write(
+                        f"alias man{i}hw='{dummysigner} {man.man_keychain.hd.get_xpriv()} > /dev/null'\n"
+                    )
+        for i, stkman in enumerate(rn.stkman_wallets):
+            f.write(
+                f'alias stkman{i}cli="{revault_cli} --conf {stkman.conf_file}"\n'
+            )
+            f.write(
+                f'alias stkman{i}d="{test_framework.revaultd.REVAULTD_PATH} --conf {stkman.conf_file}"\n'
+            )
+            if WITH_GUI:
                 f.write(
-                    f'alias stkman{i}d="{test_framework.revaultd.REVAULTD_PATH} --conf {stkman.conf_file}"\n'
+                    f"alias stkman{i}gui='{revault_gui} --conf {stkman.gui_conf_file} > /dev/null'\n"
                 )
-                if WITH_GUI:
+                if WITH_ALL_HWS:
                     f.write(
-                        f"alias stkman{i}gui='{revault_gui} --conf {stkman.gui_conf_file} > /dev/null'\n"
+                        f"alias stkman{i}hwstk='{dummysigner} {stkman.stk_keychain.hd.get_xpriv()} > /dev/null'\n"
                     )
-                    if WITH_ALL_HWS:
-                        f.write(
-                            f"alias stkman{i}hwstk='{dummysigner} {stkman.stk_keychain.hd.get_xpriv()} > /dev/null'\n"
-                        )
-                        f.write(
-                            f"alias stkman{i}hwman='{dummysigner} {stkman.man_keychain.hd.get_xpriv()} > /dev/null'\n"
-                        )
-            # hw for all the keys.
-            if WITH_GUI:
-                f.write(f"alias hw='{dummysigner} --conf {dummysigner_conf_file} > /dev/null'\n")
+                    f.write(
+                        f"alias stkman{i}hwman='{dummysigner} {stkman.man_keychain.hd.get_xpriv()} > /dev/null'\n"
+                    )
+        # hw for all the keys.
+        if WITH_GUI:
+            f.write(f"alias hw='{dummysigner} --conf {dummysigner_conf_file} > /dev/null'\n")
 
-        with open(aliases_file, "r") as f:
-            available_aliases = "".join(f.readlines()[1:])
-        print("Dropping you into a shell. Exit to end the session.", end="\n\n")
-        print(f"Available aliases: \n{available_aliases}\n")
-        # In any case clean up all daemons before exiting
-        try:
-            subprocess.call([SHELL, "--init-file", f"{aliases_file}", "-i"])
-        except Exception as e:
-            logging.error(f"Got error: '{str(e)}'")
-            logging.error(traceback.format_exc())
-        finally:
-            logging.info("Cleaning up Revault deployment")
-            rn.cleanup()
+    with open(aliases_file, "r") as f:
+        available_aliases = "".join(l for l in f if l.startswith("alias "))
+    if WITH_GUI and LAZY_GUI:
+        logging.info(
+            f"Building revault-gui in the background, see '{gui_build_log}'."
+            " The GUI aliases will wait for it to complete."
+        )
+        start_gui_build(gui_bin_dir, gui_build_log, profile)
+    logging.info(
+        f"The deployment manifest is at '{manifest_path()}', use"
+        " RevaultNetwork.attach() to drive it from another process."
+    )
+    print("Dropping you into a shell. Exit to end the session.", end="\n\n")
+    print(f"Available aliases: \n{available_aliases}\n")
+    try:
+        subprocess.call([SHELL, "--init-file", f"{aliases_file}", "-i"])
     except Exception as e:
         logging.error(f"Got error: '{str(e)}'")
         logging.error(traceback.format_exc())
-    finally:
-        logging.info("Cleaning up bitcoind")
-        bd.cleanup()
+
+
+# The scenario operations, along with the state of the vaults they take (if any)
+# and the state of the vaults they leave (if tracked).
+SCENARIO_OPS = {
+    "fundmany": (None, "funded"),
+    "secure_vaults": ("funded", "secured"),
+    "activate_vaults": ("secured", "active"),
+    "activate_fresh_vaults": ("funded", "active"),
+    "unvault_vaults": ("active", "unvaulted"),
+    "spend_vaults": ("active", None),
+    "cancel_vault": ("unvaulted", None),
+    "generate_blocks": (None, None),
+    "reorg": (None, None),
+}
+
+
+def load_scenario(path):
+    """Load and check the list of steps of the scenario at {path}.
+
+    A scenario is a JSON object with a list of "steps". Each step has an "op" (see
+    SCENARIO_OPS) operating on the vaults left in the right state by the previous
+    steps: all of them, or only "count" of them. "fundmany" creates either the
+    vaults of the given "amounts" or "count" vaults of "amount" (default 0.5) BTC.
+    "generate_blocks" mines "count" blocks and "reorg" re-organizes the last
+    "depth" blocks, optionally shifting the transactions by "shift" blocks.
+    """
+    with open(path) as f:
+        scenario = json.load(f)
+    if not isinstance(scenario.get("steps"), list):
+        raise ValueError("A scenario must have a list of 'steps'")
+
+    for i, step in enumerate(scenario["steps"]):
+        op = step.get("op")
+        if op not in SCENARIO_OPS:
+            raise ValueError(f"Step {i}: unknown operation '{op}'")
+        count = step.get("count")
+        if count is not None and (not isinstance(count, int) or count < 1):
+            raise ValueError(f"Step {i}: invalid count '{count}'")
+        if op == "fundmany" and count is None and len(step.get("amounts", [])) == 0:
+            raise ValueError(f"Step {i}: 'fundmany' needs a 'count' or 'amounts'")
+        if op == "generate_blocks" and count is None:
+            raise ValueError(f"Step {i}: 'generate_blocks' needs a 'count'")
+        if op == "reorg" and not isinstance(step.get("depth"), int):
+            raise ValueError(f"Step {i}: 'reorg' needs a 'depth'")
+
+    return scenario["steps"]
+
+
+def run_step(rn, vaults, step):
+    """Run this scenario {step}, moving the vaults it processed between the
+    {vaults} pools. Returns the number of vaults processed."""
+    op = step["op"]
+    (from_state, to_state) = SCENARIO_OPS[op]
+
+    if from_state is not None:
+        count = step.get("count", len(vaults[from_state]))
+        if count > len(vaults[from_state]):
+            raise ValueError(
+                f"'{op}' needs {count} '{from_state}' vaults but only"
+                f" {len(vaults[from_state])} are available"
+            )
+        step_vaults = vaults[from_state][:count]
+        vaults[from_state] = vaults[from_state][count:]
+
+    if op == "fundmany":
+        amounts = step.get("amounts") or [step.get("amount", 0.5)] * step["count"]
+        # Make sure we can pay for all of them (plus fees)
+        rn.bitcoind.get_coins(sum(amounts) + 1)
+        step_vaults = rn.fundmany(amounts)
+    elif op == "secure_vaults":
+        rn.secure_vaults(step_vaults)
+    elif op == "activate_vaults":
+        rn.activate_vaults(step_vaults)
+    elif op == "activate_fresh_vaults":
+        rn.activate_fresh_vaults(step_vaults)
+    elif op == "unvault_vaults":
+        rn.unvault_vaults_anyhow(step_vaults)
+    elif op == "spend_vaults":
+        rn.spend_vaults_anyhow(step_vaults)
+    elif op == "cancel_vault":
+        for v in step_vaults:
+            rn.cancel_vault(v)
+    elif op == "generate_blocks":
+        rn.generate_blocks(step["count"])
+        return 0
+    elif op == "reorg":
+        height = rn.bitcoind.rpc.getblockcount() - step["depth"] + 1
+        rn.bitcoind.simple_reorg(height, step.get("shift", 0))
+        return 0
+
+    if to_state is not None:
+        vaults[to_state] += step_vaults
+    return len(step_vaults)
+
+
+def run_scenario(rn, steps):
+    """Run these scenario {steps} against the deployment, timing each of them."""
+    vaults = {state: [] for (_, state) in SCENARIO_OPS.values() if state is not None}
+    results = []
+    for i, step in enumerate(steps):
+        logging.info(f"Running step {i}: {step}")
+        start = time.monotonic()
+        n_vaults = run_step(rn, vaults, step)
+        elapsed = time.monotonic() - start
+        logging.info(f"Step {i} ('{step['op']}') took {elapsed:.2f}s")
+        results.append(
+            {
+                "step": step,
+                "vaults": n_vaults,
+                "elapsed": elapsed,
+                "vaults_per_sec": n_vaults / elapsed if n_vaults > 0 else None,
+            }
+        )
+    return results
+
+
+def run_scenario_session(scenario_file, results_file, rn, bd, bins, profile="debug"):
+    """Run the scenario at {scenario_file} and write the results to {results_file}.
+    This is the non-interactive counterpart of run_shell()."""
+    steps = load_scenario(scenario_file)
+    start = time.monotonic()
+    results = run_scenario(rn, steps)
+    total = time.monotonic() - start
+
+    with open(results_file, "w") as f:
+        json.dump(
+            {
+                "scenario": os.path.abspath(scenario_file),
+                "versions": daemons_versions(),
+                "profile": profile,
+                "topology": {
+                    "stakeholders": len(rn.stk_wallets),
+                    "managers": len(rn.man_wallets),
+                    "stkmanagers": len(rn.stkman_wallets),
+                    "csv": rn.csv,
+                    "managers_threshold": rn.layout["managers_threshold"],
+                    "with_cosigs": rn.layout["with_cosigs"],
+                    "with_watchtowers": rn.layout["with_watchtowers"],
+                },
+                "steps": results,
+                "elapsed": total,
+                "bitcoind_rpc_latency": bd.rpc.latency_stats(),
+            },
+            f,
+            indent=2,
+        )
+    logging.info(f"Ran the scenario in {total:.2f}s, results are in '{results_file}'")
 
 
 def setup_logging():
@@ -388,28 +1132,24 @@ def parse_args():
         "--stakeholders",
         type=int,
         help="The number of only-stakeholder",
-        required=True,
     )
     deploy_config.add_argument(
         "-mans",
         "--managers",
         type=int,
         help="The number of only-manager",
-        required=True,
     )
     deploy_config.add_argument(
         "-stkmans",
         "--stakeholder-managers",
         type=int,
         help="The number of both stakeholder-manager",
-        required=True,
     )
     deploy_config.add_argument(
         "-csv",
         "--timelock",
         type=int,
         help="The number of blocks during which an Unvault attempt can be canceled",
-        required=True,
     )
     deploy_config.add_argument(
         "-mansthresh",
@@ -432,19 +1172,90 @@ def parse_args():
              "watchtower plugin. Specify this option multiple times to enable multiple "
              "policies.",
     )
-    return parser.parse_args()
+    build_config = parser.add_argument_group("Build configuration")
+    build_config.add_argument(
+        "-profile",
+        "--profile",
+        default="debug",
+        help="The Cargo profile to build the binaries with: 'debug', 'release' or the "
+             "name of a custom profile.",
+    )
+    snapshot_config = parser.add_argument_group("Snapshots")
+    snapshot_config.add_argument(
+        "-snapshot",
+        "--snapshot",
+        metavar="NAME",
+        help="Save the whole deployment as snapshot NAME when exiting the shell.",
+    )
+    snapshot_config.add_argument(
+        "-restore",
+        "--restore",
+        metavar="NAME",
+        help="Restore the deployment saved as snapshot NAME instead of creating a "
+             "new one.",
+    )
+    scenario_config = parser.add_argument_group("Scenarios")
+    scenario_config.add_argument(
+        "-scenario",
+        "--scenario",
+        metavar="FILE",
+        help="Run the scenario described in this JSON file instead of dropping into "
+             "a shell.",
+    )
+    scenario_config.add_argument(
+        "-results",
+        "--results",
+        metavar="FILE",
+        default="results.json",
+        help="Where to write the timings of the scenario steps (default: "
+             "'results.json').",
+    )
+    args = parser.parse_args()
+
+    if args.restore is None:
+        required = {
+            "--stakeholders": args.stakeholders,
+            "--managers": args.managers,
+            "--stakeholder-managers": args.stakeholder_managers,
+            "--timelock": args.timelock,
+        }
+        missing = [opt for opt, value in required.items() if value is None]
+        if len(missing) > 0:
+            parser.error(
+                f"the following arguments are required: {', '.join(missing)}"
+            )
+
+    return args
 
 
 if __name__ == "__main__":
     setup_logging()
 
     args = parse_args()
-    deploy(
-        args.stakeholders,
-        args.managers,
-        args.stakeholder_managers,
-        args.timelock,
-        args.managers_threshold,
-        args.with_cosigning_servers,
-        args.policies,
-    )
+    session = None
+    if args.scenario is not None:
+        # Fail early on an invalid scenario, not after deploying
+        try:
+            load_scenario(args.scenario)
+        except (OSError, ValueError) as e:
+            logging.error(f"Invalid scenario '{args.scenario}': {str(e)}")
+            sys.exit(1)
+        session = functools.partial(
+            run_scenario_session, args.scenario, os.path.abspath(args.results)
+        )
+
+    if args.restore is not None:
+        restore(args.restore, args.profile, args.snapshot, session)
+    else:
+        deploy(
+            args.stakeholders,
+            args.managers,
+            args.stakeholder_managers,
+            args.timelock,
+            args.managers_threshold,
+            args.with_cosigning_servers,
+            args.policies,
+            args.profile,
+            args.snapshot,
+            session,
+        )
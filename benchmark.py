@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""Measure how fast each phase of the vaults lifecycle goes, across topologies.
+
+For each combination of the given topology parameters and vault counts, a fresh
+Revault network is deployed and the vaults are funded, secured, activated and then
+half of them are unvaulted and canceled while the other half is spent. The
+throughput of each phase (in vaults per second) is written to a JSON results file,
+which can be compared against a previous one.
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import sys
+import time
+import traceback
+
+from aquarium import (
+    BASE_DIR,
+    build_all_binaries,
+    bitcoind,
+    check_base_dir,
+    daemons_versions,
+    executor,
+    run_scenario,
+    setup_logging,
+    use_binaries,
+)
+from test_framework.revault_network import RevaultNetwork
+from test_framework.utils import (
+    POSTGRES_USER,
+    POSTGRES_PASS,
+    POSTGRES_HOST,
+    POSTGRES_IS_SETUP,
+)
+
+# Bump this whenever the format of the results changes
+RESULTS_VERSION = 2
+# The phases we measure, in the order they are run
+PHASES = [
+    "fundmany",
+    "secure_vaults",
+    "activate_vaults",
+    "unvault_vaults",
+    "cancel_vault",
+    "spend_vaults",
+]
+
+
+def lifecycle_steps(n_vaults, batch_size):
+    """Get the scenario steps for the lifecycle of {n_vaults} vaults. Unvaults and
+    Spends are done by batches of up to {batch_size} vaults."""
+    steps = [
+        {"op": "fundmany", "count": n_vaults},
+        {"op": "secure_vaults"},
+        {"op": "activate_vaults"},
+    ]
+    n_canceled = n_vaults // 2
+    for i in range(0, n_canceled, batch_size):
+        count = min(batch_size, n_canceled - i)
+        steps.append({"op": "unvault_vaults", "count": count})
+        steps.append({"op": "cancel_vault"})
+    for i in range(0, n_vaults - n_canceled, batch_size):
+        count = min(batch_size, n_vaults - n_canceled - i)
+        steps.append({"op": "spend_vaults", "count": count})
+    return steps
+
+
+def phases_throughput(steps_results):
+    """Aggregate the results of the scenario steps by phase."""
+    phases = {}
+    for res in steps_results:
+        phase = phases.setdefault(res["step"]["op"], {"vaults": 0, "elapsed": 0})
+        phase["vaults"] += res["vaults"]
+        phase["elapsed"] += res["elapsed"]
+    for phase in phases.values():
+        phase["vaults_per_sec"] = (
+            phase["vaults"] / phase["elapsed"] if phase["elapsed"] > 0 else None
+        )
+    return phases
+
+
+def run_key(run):
+    """What identifies a run across results files."""
+    topo = run["topology"]
+    return (
+        topo["stakeholders"],
+        topo["managers"],
+        topo["with_cosigs"],
+        topo["with_watchtowers"],
+        topo["csv"],
+        run["vaults"],
+        run["batch_size"],
+    )
+
+
+def run_name(run):
+    (stks, mans, cosigs, wts, csv, vaults, batch_size) = run_key(run)
+    return (
+        f"{stks} stks, {mans} mans, cosigs {'on' if cosigs else 'off'},"
+        f" watchtowers {'on' if wts else 'off'}, csv {csv}, {vaults} vaults"
+        f" by batches of {batch_size}"
+    )
+
+
+def diff_results(results, baseline, threshold):
+    """Compare the throughput of each phase of each run to the {baseline}.
+
+    Returns the list of the differences, which are regressions if the throughput
+    dropped by more than {threshold} percent or if a phase of the baseline has no
+    throughput in the new results.
+    """
+    baseline_runs = {run_key(run): run for run in baseline["runs"]}
+    diffs = []
+    for run in results["runs"]:
+        base_run = baseline_runs.get(run_key(run))
+        if base_run is None:
+            logging.warning(f"No baseline for run '{run_name(run)}'")
+            continue
+        for phase in PHASES:
+            new = run["phases"].get(phase, {}).get("vaults_per_sec")
+            old = base_run["phases"].get(phase, {}).get("vaults_per_sec")
+            if old is None:
+                continue
+            if new is None:
+                logging.warning(f"No throughput for '{phase}' of run '{run_name(run)}'")
+                change = None
+            else:
+                change = (new - old) / old * 100
+            diffs.append(
+                {
+                    "run": run_name(run),
+                    "phase": phase,
+                    "baseline": old,
+                    "current": new,
+                    "change_percent": change,
+                    "regression": change is None or change < -threshold,
+                }
+            )
+    return diffs
+
+
+def benchmark(bd, ex, topology, n_vaults, batch_size, csv):
+    """Deploy a network with this {topology} and time the lifecycle of {n_vaults}
+    vaults, using the executor {ex}. Returns the results of this run."""
+    (n_stks, n_mans, with_cosigs, with_wts) = topology
+    root_dir = os.path.join(
+        BASE_DIR,
+        f"{n_stks}stks-{n_mans}mans-{int(with_cosigs)}cosigs-{int(with_wts)}wts-{n_vaults}",
+    )
+    os.makedirs(root_dir)
+
+    rn = RevaultNetwork(
+        root_dir,
+        bd,
+        ex,
+        POSTGRES_USER,
+        POSTGRES_PASS,
+        POSTGRES_HOST,
+    )
+    try:
+        start = time.monotonic()
+        rn.deploy(
+            n_stks,
+            n_mans,
+            csv=csv,
+            with_cosigs=with_cosigs,
+            with_watchtowers=with_wts,
+        )
+        deploy_time = time.monotonic() - start
+        steps_results = run_scenario(rn, lifecycle_steps(n_vaults, batch_size))
+    finally:
+        rn.cleanup()
+
+    return {
+        "topology": {
+            "stakeholders": n_stks,
+            "managers": n_mans,
+            "with_cosigs": with_cosigs,
+            "with_watchtowers": with_wts,
+            "csv": csv,
+        },
+        "vaults": n_vaults,
+        "batch_size": batch_size,
+        "deploy_elapsed": deploy_time,
+        "phases": phases_throughput(steps_results),
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    sweep_config = parser.add_argument_group("Sweep configuration")
+    sweep_config.add_argument(
+        "-stks",
+        "--stakeholders",
+        type=int,
+        nargs="+",
+        default=[2],
+        help="The numbers of stakeholders to benchmark",
+    )
+    sweep_config.add_argument(
+        "-mans",
+        "--managers",
+        type=int,
+        nargs="+",
+        default=[1],
+        help="The numbers of managers to benchmark",
+    )
+    sweep_config.add_argument(
+        "-cosigs",
+        "--cosigning-servers",
+        choices=["off", "on"],
+        nargs="+",
+        default=["off"],
+        help="Whether to benchmark with cosigning servers, without, or both",
+    )
+    sweep_config.add_argument(
+        "-wts",
+        "--watchtowers",
+        choices=["off", "on"],
+        nargs="+",
+        default=["off"],
+        help="Whether to benchmark with watchtowers, without, or both",
+    )
+    sweep_config.add_argument(
+        "-vaults",
+        "--vaults",
+        type=int,
+        nargs="+",
+        default=[10],
+        help="The numbers of vaults to benchmark",
+    )
+    sweep_config.add_argument(
+        "-batch",
+        "--batch-size",
+        type=int,
+        default=10,
+        help="The maximum number of vaults unvaulted or spent at once",
+    )
+    sweep_config.add_argument(
+        "-csv",
+        "--timelock",
+        type=int,
+        default=6,
+        help="The CSV of the deployments. Keep it low as it is mined for each Spend.",
+    )
+    results_config = parser.add_argument_group("Results")
+    results_config.add_argument(
+        "-results",
+        "--results",
+        metavar="FILE",
+        default="benchmark.json",
+        help="Where to write the results (default: 'benchmark.json')",
+    )
+    results_config.add_argument(
+        "-baseline",
+        "--baseline",
+        metavar="FILE",
+        help="A previous results file to compare the throughput against",
+    )
+    results_config.add_argument(
+        "-threshold",
+        "--regression-threshold",
+        type=float,
+        default=10,
+        help="The drop in throughput, in percent, above which a phase is considered "
+             "to have regressed (default: 10)",
+    )
+    build_config = parser.add_argument_group("Build configuration")
+    build_config.add_argument(
+        "-profile",
+        "--profile",
+        default="release",
+        help="The Cargo profile to build the binaries with (default: 'release')",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    setup_logging()
+    args = parse_args()
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("version") != RESULTS_VERSION:
+            logging.error(f"Unsupported baseline results version in '{args.baseline}'")
+            sys.exit(1)
+        # Binaries built with another profile aren't comparable
+        if baseline["profile"] != args.profile:
+            logging.error(
+                f"Baseline '{args.baseline}' was built with the '{baseline['profile']}'"
+                f" profile, not '{args.profile}'"
+            )
+            sys.exit(1)
+
+    topologies = list(
+        itertools.product(
+            args.stakeholders,
+            args.managers,
+            [c == "on" for c in args.cosigning_servers],
+            [w == "on" for w in args.watchtowers],
+        )
+    )
+    if min(args.stakeholders) < 2 or min(args.managers) < 1:
+        logging.error("Need at least 2 stakeholders and 1 manager")
+        sys.exit(1)
+
+    check_base_dir()
+    bins = build_all_binaries(
+        build_cosig="on" in args.cosigning_servers,
+        build_wt="on" in args.watchtowers,
+        build_coordinator=POSTGRES_IS_SETUP,
+        profile=args.profile,
+    )
+    use_binaries(bins)
+
+    logging.info("Setting up bitcoind")
+    bd = bitcoind()
+    results = {
+        "version": RESULTS_VERSION,
+        "versions": daemons_versions(),
+        "profile": args.profile,
+        "runs": [],
+    }
+    failed = False
+    try:
+        with executor() as ex:
+            for topology, n_vaults in itertools.product(topologies, args.vaults):
+                logging.info(f"Benchmarking {topology} with {n_vaults} vaults")
+                results["runs"].append(
+                    benchmark(
+                        bd, ex, topology, n_vaults, args.batch_size, args.timelock
+                    )
+                )
+                for phase, res in results["runs"][-1]["phases"].items():
+                    if res["vaults_per_sec"] is not None:
+                        logging.info(f"  {phase}: {res['vaults_per_sec']:.2f} vaults/s")
+    except Exception as e:
+        logging.error(f"Got error: '{str(e)}'")
+        logging.error(traceback.format_exc())
+        failed = True
+    finally:
+        logging.info("Cleaning up bitcoind")
+        bd.cleanup()
+
+    if baseline is not None:
+        results["baseline"] = os.path.abspath(args.baseline)
+        results["diff"] = diff_results(
+            results, baseline, args.regression_threshold
+        )
+        for d in results["diff"]:
+            if d["change_percent"] is None:
+                logging.warning(f"{d['run']}, {d['phase']}: missing")
+                continue
+            log = logging.warning if d["regression"] else logging.info
+            log(f"{d['run']}, {d['phase']}: {d['change_percent']:+.1f}%")
+
+    with open(args.results, "w") as f:
+        json.dump(results, f, indent=2)
+    logging.info(f"Results written to '{args.results}'")
+
+    # The results of the runs completed before a failure are still written above
+    if failed or any(d["regression"] for d in results.get("diff", [])):
+        sys.exit(1)
@@ -2,34 +2,215 @@ import decimal
 import json
 import logging
 import os
+import re
+import shutil
+import subprocess
 import threading
+import time
 
 from cheroot.wsgi import Server
+from concurrent import futures
 from decimal import Decimal
+from http import HTTPStatus
 from ephemeral_port_reserve import reserve
 from flask import Flask, request, Response
 from test_framework.authproxy import AuthServiceProxy, JSONRPCException
-from test_framework.utils import TailableProc, wait_for, TIMEOUT, BITCOIND_PATH, COIN
+from test_framework.utils import (
+    TailableProc,
+    wait_for,
+    NOTIFIER,
+    TIMEOUT,
+    BITCOIND_PATH,
+    BITCOIND_ZMQ,
+    COIN,
+    TIME_ACCELERATION,
+)
+
+try:
+    import zmq
+except ImportError:
+    # We poll bitcoind instead of being notified by it
+    zmq = None
+
+
+# How much the mocked clock advances with each generated block, in seconds
+BLOCK_INTERVAL_SECS = 10 * 60
+# The maximum number of blocks generated per batch request in accelerated mode
+MOCKTIME_BATCH_BLOCKS = 100
+# Bump this whenever the content of the chain templates changes
+CHAIN_TEMPLATE_VERSION = 1
+# Files that are specific to a bitcoind instance, and shouldn't be part of a template
+CHAIN_TEMPLATE_IGNORED = [
+    ".cookie",
+    ".lock",
+    "debug.log",
+    "bitcoind.pid",
+    "peers.dat",
+    "anchors.dat",
+    "banlist.json",
+    "mempool.dat",
+    "fee_estimates.dat",
+]
+
+
+def link_or_copy(src, dst):
+    """LevelDB tables are never modified once written, so we can hardlink them
+    instead of copying them. Everything else (block files, wallets) is copied."""
+    if src.endswith(".ldb"):
+        try:
+            os.link(src, dst)
+            return dst
+        except OSError:
+            pass
+    return shutil.copy2(src, dst)
+
+
+class RpcBatch:
+    """Calls to bitcoind queued to be sent in a single request when leaving the `with`
+    block. Each call returns a Future of its result."""
+
+    def __init__(self, rpc):
+        self.rpc = rpc
+        self.calls = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.send()
+        else:
+            for _, _, fut in self.calls:
+                fut.cancel()
+
+    def send(self):
+        calls, self.calls = self.calls, []
+        if len(calls) == 0:
+            return
+        resps = self.rpc.call_batch([(name, args) for name, args, _ in calls])
+        for (_, _, fut), resp in zip(calls, resps):
+            if resp.get("error") is not None:
+                fut.set_exception(JSONRPCException(resp["error"]))
+            else:
+                fut.set_result(resp["result"])
+
+    def __getattr__(self, name):
+        assert not (name.startswith("__") and name.endswith("__")), "Python internals"
+
+        def f(*args):
+            fut = futures.Future()
+            self.calls.append((name, args, fut))
+            return fut
+
+        f.__name__ = name
+        return f
 
 
 class BitcoindRpcInterface:
+    """A client to bitcoind's RPC interface.
+
+    The cookie is read once, and again only if bitcoind rejects it (it was restarted).
+    Each thread keeps its own keep-alive HTTP connection, as they can't be shared.
+    """
+
     def __init__(self, data_dir, network, rpc_port):
         self.cookie_path = os.path.join(data_dir, network, ".cookie")
         self.rpc_port = rpc_port
         self.wallet_name = "revaultd-tests"
 
+        self.lock = threading.Lock()
+        self.authpair = None
+        # Bumped each time we reload the cookie, to reconnect with the new one
+        self.cookie_generation = 0
+        self.local = threading.local()
+        # Method name -> number of calls, total and max latency in seconds
+        self.latencies = {}
+
+    def _reload_cookie(self, generation):
+        """Read the cookie again, unless another thread did since {generation}"""
+        with self.lock:
+            if self.cookie_generation == generation:
+                with open(self.cookie_path) as fd:
+                    self.authpair = fd.read()
+                self.cookie_generation += 1
+
+    def _proxy(self):
+        if self.authpair is None:
+            self._reload_cookie(0)
+        proxy = getattr(self.local, "proxy", None)
+        if proxy is None or self.local.generation != self.cookie_generation:
+            self.local.generation = self.cookie_generation
+            service_url = (
+                f"http://{self.authpair}@localhost:{self.rpc_port}"
+                f"/wallet/{self.wallet_name}"
+            )
+            proxy = AuthServiceProxy(service_url)
+            self.local.proxy = proxy
+        return proxy
+
+    def _record_latency(self, name, elapsed):
+        with self.lock:
+            (calls, total, worst) = self.latencies.get(name, (0, 0, 0))
+            self.latencies[name] = (calls + 1, total + elapsed, max(worst, elapsed))
+
+    def latency_stats(self):
+        """The number of calls and the mean and max latency of each RPC method"""
+        with self.lock:
+            return {
+                name: {"calls": calls, "mean": total / calls, "max": worst}
+                for name, (calls, total, worst) in self.latencies.items()
+            }
+
+    def call(self, name, *args):
+        generation = self.cookie_generation
+        start = time.monotonic()
+        try:
+            return getattr(self._proxy(), name)(*args)
+        except JSONRPCException as e:
+            if e.http_status != HTTPStatus.UNAUTHORIZED:
+                raise
+            # bitcoind was restarted and has a new cookie
+            self._reload_cookie(generation)
+            return getattr(self._proxy(), name)(*args)
+        finally:
+            self._record_latency(name, time.monotonic() - start)
+
+    def call_batch(self, calls):
+        """Send all these (method, args) {calls} in a single JSONRPC batch request.
+        Returns the responses in the same order."""
+        generation = self.cookie_generation
+        start = time.monotonic()
+
+        def send():
+            proxy = self._proxy()
+            requests = [getattr(proxy, name).get_request(*args) for name, args in calls]
+            resps = {r["id"]: r for r in proxy.batch(requests)}
+            return [resps[req["id"]] for req in requests]
+
+        try:
+            return send()
+        except JSONRPCException as e:
+            if e.http_status != HTTPStatus.UNAUTHORIZED:
+                raise
+            self._reload_cookie(generation)
+            return send()
+        finally:
+            self._record_latency("batch", time.monotonic() - start)
+
+    def batch(self):
+        """Queue calls to be sent at once, as in:
+
+            with bitcoind.rpc.batch() as b:
+                count = b.getblockcount()
+            count.result()
+        """
+        return RpcBatch(self)
+
     def __getattr__(self, name):
         assert not (name.startswith("__") and name.endswith("__")), "Python internals"
 
-        with open(self.cookie_path) as fd:
-            authpair = fd.read()
-        service_url = (
-            f"http://{authpair}@localhost:{self.rpc_port}/wallet/{self.wallet_name}"
-        )
-        proxy = AuthServiceProxy(service_url, name)
-
         def f(*args):
-            return proxy.__call__(*args)
+            return self.call(name, *args)
 
         # Make debuggers show <function bitcoin.rpc.name> rather than <function
         # bitcoin.rpc.<lambda>>
@@ -37,22 +218,155 @@ class BitcoindRpcInterface:
         return f
 
 
+class ChainView:
+    """The tip height and mempool of bitcoind, kept up to date from its ZMQ
+    'sequence' notifications by a subscriber thread."""
+
+    # The maximum number of notifications handled at once
+    DRAIN_MAX = 1024
+
+    def __init__(self, rpc, zmq_address):
+        self.rpc = rpc
+        self.zmq_address = zmq_address
+        self.cond = threading.Condition()
+        self.height = None
+        self.mempool = set()
+        self.stopped = False
+        self.thread = None
+
+    def start(self):
+        subscribed = threading.Event()
+        self.thread = threading.Thread(
+            target=self._run, args=(subscribed,), name="bitcoind-zmq", daemon=True
+        )
+        self.thread.start()
+        subscribed.wait()
+        # We may get notifications for what is already in here, that's fine
+        self._sync()
+
+    def _sync(self):
+        """Get the height and mempool from the RPC interface"""
+        height = self.rpc.getblockcount()
+        mempool = self.rpc.getrawmempool()
+        with self.cond:
+            self.height = height
+            self.mempool = set(mempool)
+            self.cond.notify_all()
+
+    def _run(self, subscribed):
+        ctx = zmq.Context.instance()
+        sock = ctx.socket(zmq.SUB)
+        sock.setsockopt(zmq.SUBSCRIBE, b"sequence")
+        sock.connect(self.zmq_address)
+        subscribed.set()
+        try:
+            while not self.stopped:
+                if sock.poll(500) == 0:
+                    continue
+                # Drain what's pending, to resync once for a burst of blocks
+                bodies = []
+                while len(bodies) < self.DRAIN_MAX and sock.poll(0) != 0:
+                    (_, body, _) = sock.recv_multipart()
+                    bodies.append(body)
+                self._handle(bodies)
+        except Exception as e:
+            logging.error(f"Error in bitcoind ZMQ subscriber: '{e}'")
+        finally:
+            sock.close(linger=0)
+
+    def _handle(self, bodies):
+        # <32 bytes hash>|<1 byte label>|<8 bytes mempool sequence for A and R>
+        labels = [body[32:33] for body in bodies]
+        if b"C" in labels or b"D" in labels:
+            # Transactions removed from the mempool for being included in a block
+            # are not notified, resync it on block (dis)connection. The resync
+            # also covers the mempool changes notified along.
+            self._sync()
+        else:
+            with self.cond:
+                for body, label in zip(bodies, labels):
+                    if label == b"A":
+                        self.mempool.add(body[:32].hex())
+                    elif label == b"R":
+                        self.mempool.discard(body[:32].hex())
+                self.cond.notify_all()
+        NOTIFIER.notify()
+
+    def wait_for(self, predicate, timeout=TIMEOUT):
+        """Wait for {predicate} to be true of this view"""
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.cond:
+                # Resync every second in case we missed a notification
+                remaining = deadline - time.monotonic()
+                if self.cond.wait_for(lambda: predicate(self), min(remaining, 1)):
+                    return
+            if remaining <= 1:
+                raise TimeoutError("Timed out waiting on bitcoind notifications")
+            self._sync()
+
+    def stop(self):
+        self.stopped = True
+        if self.thread is not None:
+            self.thread.join()
+
+
+# The events parsed from bitcoind's logs, keyed by block hash
+BITCOIND_EVENTS = [
+    (
+        "block_connected",
+        r"UpdateTip: new best=(?P<key>[0-9a-f]{64}) height=(?P<height>\d+)",
+    ),
+]
+
+
 class BitcoinD(TailableProc):
-    def __init__(self, bitcoin_dir, rpcport=None):
+    def __init__(
+        self,
+        bitcoin_dir,
+        rpcport=None,
+        chain_templates_dir=None,
+        p2pport=None,
+        write_files=True,
+    ):
+        """If {chain_templates_dir} is set and contains a template for this bitcoind
+        version, the regtest chain and wallet are initialized from it. See
+        save_chain_template().
+
+        If {write_files} is False, the datadir and configuration are left untouched
+        and only the RPC client is set up, to talk to an already running bitcoind.
+        """
         TailableProc.__init__(self, bitcoin_dir, verbose=False)
 
         if rpcport is None:
             rpcport = reserve()
+        if p2pport is None:
+            p2pport = reserve()
 
         self.bitcoin_dir = bitcoin_dir
         self.rpcport = rpcport
-        self.p2pport = reserve()
+        self.p2pport = p2pport
         self.prefix = "bitcoind"
+        self.events.set_patterns(BITCOIND_EVENTS)
 
         regtestdir = os.path.join(bitcoin_dir, "regtest")
-        if not os.path.exists(regtestdir):
+        if write_files and not os.path.exists(regtestdir):
             os.makedirs(regtestdir)
 
+        self.chain_templates_dir = chain_templates_dir
+        self.from_template = False
+        if write_files and chain_templates_dir is not None:
+            template_dir = self.chain_template_dir()
+            if os.path.isdir(template_dir):
+                logging.debug(f"Using chain template at '{template_dir}'")
+                shutil.copytree(
+                    template_dir,
+                    regtestdir,
+                    copy_function=link_or_copy,
+                    dirs_exist_ok=True,
+                )
+                self.from_template = True
+
         self.cmd_line = [
             BITCOIND_PATH,
             "-datadir={}".format(bitcoin_dir),
@@ -66,48 +380,141 @@ class BitcoinD(TailableProc):
             "fallbackfee": Decimal(1000) / COIN,
             "rpcthreads": 32,
         }
+        self.chain = None
+        self.zmq_address = None
+        # The mocked time, in accelerated mode
+        self.mocktime = None
+        if write_files and zmq is not None and BITCOIND_ZMQ:
+            self.zmq_address = f"tcp://127.0.0.1:{reserve()}"
+            bitcoind_conf["zmqpubsequence"] = self.zmq_address
         self.conf_file = os.path.join(bitcoin_dir, "bitcoin.conf")
-        with open(self.conf_file, "w") as f:
-            f.write("chain=regtest\n")
-            f.write("[regtest]\n")
-            for k, v in bitcoind_conf.items():
-                f.write(f"{k}={v}\n")
+        if write_files:
+            with open(self.conf_file, "w") as f:
+                f.write("chain=regtest\n")
+                f.write("[regtest]\n")
+                for k, v in bitcoind_conf.items():
+                    f.write(f"{k}={v}\n")
 
         self.rpc = BitcoindRpcInterface(bitcoin_dir, "regtest", rpcport)
 
     def start(self):
         TailableProc.start(self)
         self.wait_for_log("Done loading", timeout=TIMEOUT)
+        # Never go back in time: the tip may be in the future if the chain was
+        # generated in accelerated mode (restart, snapshot), in which case we have to
+        # keep mocking the time even if not accelerated for new blocks to be valid.
+        tip = self.rpc.getblockheader(self.rpc.getbestblockhash())
+        if TIME_ACCELERATION > 1 or tip["time"] > time.time():
+            self.mocktime = max(int(time.time()), tip["time"])
+            self.rpc.setmocktime(self.mocktime)
+        if self.zmq_address is not None:
+            self.chain = ChainView(self.rpc, self.zmq_address)
+            self.chain.start()
 
         logging.info("BitcoinD started")
 
     def stop(self):
+        if self.chain is not None:
+            self.chain.stop()
+            self.chain = None
         self.rpc.stop()
         return TailableProc.stop(self)
 
+    def chain_template_dir(self):
+        """Get the directory of the chain template for this version of bitcoind.
+
+        A chain generated in accelerated mode has its tip in the future, so it is
+        only shared across runs with the same TIME_ACCELERATION.
+        """
+        version_str = subprocess.check_output([BITCOIND_PATH, "-version"]).decode()
+        version = re.search(r"v\d+\.\d+\S*", version_str)
+        version = version.group(0) if version is not None else "unknown"
+        name = f"{CHAIN_TEMPLATE_VERSION}-bitcoind-{version}"
+        if TIME_ACCELERATION > 1:
+            name += f"-accelerated-{TIME_ACCELERATION:g}"
+        return os.path.join(self.chain_templates_dir, name)
+
+    def save_chain_template(self):
+        """Save the current regtest chain and wallets as a template for new
+        instances.
+
+        This restarts bitcoind, as the datadir must be consistent on disk. The
+        wallets must be loaded on startup for them to be usable from the template.
+        """
+        assert self.chain_templates_dir is not None
+        template_dir = self.chain_template_dir()
+        tmp_dir = f"{template_dir}.tmp-{os.getpid()}"
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+
+        self.stop()
+        try:
+            shutil.copytree(
+                os.path.join(self.bitcoin_dir, "regtest"),
+                tmp_dir,
+                ignore=shutil.ignore_patterns(*CHAIN_TEMPLATE_IGNORED),
+            )
+            if os.path.isdir(template_dir):
+                shutil.rmtree(template_dir)
+            os.rename(tmp_dir, template_dir)
+            logging.debug(f"Saved chain template at '{template_dir}'")
+        finally:
+            self.start()
+
     # wait_for_mempool can be used to wait for the mempool before generating
     # blocks:
     # True := wait for at least 1 transation
     # int > 0 := wait for at least N transactions
     # 'tx_id' := wait for one transaction id given as a string
     # ['tx_id1', 'tx_id2'] := wait until all of the specified transaction IDs
+    def wait_for_mempool(self, txids):
+        """Wait for all these {txids} to be in the mempool, or for it to contain at
+        least {txids} transactions if it is an int."""
+        if isinstance(txids, str):
+            txids = [txids]
+        if self.chain is not None:
+            if isinstance(txids, list):
+                self.chain.wait_for(lambda c: all(txid in c.mempool for txid in txids))
+            else:
+                self.chain.wait_for(lambda c: len(c.mempool) >= txids)
+        elif isinstance(txids, list):
+            wait_for(lambda: all(txid in self.rpc.getrawmempool() for txid in txids))
+        else:
+            wait_for(lambda: len(self.rpc.getrawmempool()) >= txids)
+
+    def wait_for_height(self, height):
+        """Wait for the tip to be at {height}"""
+        if self.chain is not None:
+            self.chain.wait_for(lambda c: c.height == height)
+        else:
+            wait_for(lambda: self.rpc.getblockcount() == height)
+
     def generate_block(self, numblocks=1, wait_for_mempool=0):
         if wait_for_mempool:
-            if isinstance(wait_for_mempool, str):
-                wait_for_mempool = [wait_for_mempool]
-            if isinstance(wait_for_mempool, list):
-                wait_for(
-                    lambda: all(
-                        txid in self.rpc.getrawmempool() for txid in wait_for_mempool
-                    )
-                )
-            else:
-                wait_for(lambda: len(self.rpc.getrawmempool()) >= wait_for_mempool)
+            self.wait_for_mempool(wait_for_mempool)
 
         old_blockcount = self.rpc.getblockcount()
         addr = self.rpc.getnewaddress()
-        self.rpc.generatetoaddress(numblocks, addr)
-        wait_for(lambda: self.rpc.getblockcount() == old_blockcount + numblocks)
+        if self.mocktime is None:
+            self.rpc.generatetoaddress(numblocks, addr)
+        else:
+            self._generate_mocktime(numblocks, "generatetoaddress", 1, addr)
+        NOTIFIER.notify()
+        self.wait_for_height(old_blockcount + numblocks)
+
+    def _generate_mocktime(self, n, method, *args):
+        """Generate {n} blocks one at a time with {method}, advancing the mocked time
+        by BLOCK_INTERVAL_SECS before each of them. This is done by batch requests of
+        up to MOCKTIME_BATCH_BLOCKS blocks."""
+        for i in range(0, n, MOCKTIME_BATCH_BLOCKS):
+            with self.rpc.batch() as b:
+                results = []
+                for _ in range(min(MOCKTIME_BATCH_BLOCKS, n - i)):
+                    self.mocktime += BLOCK_INTERVAL_SECS
+                    b.setmocktime(self.mocktime)
+                    results.append(getattr(b, method)(*args))
+            for res in results:
+                res.result()
 
     def get_coins(self, amount_btc):
         # subsidy halving is every 150 blocks on regtest, it's a rough estimate
@@ -119,17 +526,27 @@ class BitcoinD(TailableProc):
     def generate_blocks_censor(self, n, txids):
         """Generate {n} blocks ignoring {txids}"""
         fee_delta = 1000000
-        for txid in txids:
-            self.rpc.prioritisetransaction(txid, None, -fee_delta)
+        with self.rpc.batch() as b:
+            results = [b.prioritisetransaction(txid, None, -fee_delta) for txid in txids]
+        for res in results:
+            res.result()
         self.generate_block(n)
-        for txid in txids:
-            self.rpc.prioritisetransaction(txid, None, fee_delta)
+        with self.rpc.batch() as b:
+            results = [b.prioritisetransaction(txid, None, fee_delta) for txid in txids]
+        for res in results:
+            res.result()
 
     def generate_empty_blocks(self, n):
         """Generate {n} empty blocks"""
         addr = self.rpc.getnewaddress()
-        for _ in range(n):
-            self.rpc.generateblock(addr, [])
+        if self.mocktime is None:
+            with self.rpc.batch() as b:
+                blocks = [b.generateblock(addr, []) for _ in range(n)]
+            for block in blocks:
+                block.result()
+        else:
+            self._generate_mocktime(n, "generateblock", addr, [])
+        NOTIFIER.notify()
 
     def simple_reorg(self, height, shift=0):
         """
@@ -172,7 +589,10 @@ class BitcoinD(TailableProc):
         else:
             self.generate_empty_blocks(shift)
             self.generate_block(1 + final_len - (height + shift), memp)
-        self.wait_for_log(r"UpdateTip: new best=.* height={}".format(final_len))
+        if self.chain is not None:
+            self.wait_for_height(final_len)
+        else:
+            self.wait_for_log(r"UpdateTip: new best=.* height={}".format(final_len))
 
     def startup(self):
         try:
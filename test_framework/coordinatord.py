@@ -16,6 +16,7 @@ from test_framework.utils import (
     LOG_LEVEL,
     COORDINATORD_PATH,
     TIMEOUT,
+    scaled_interval,
 )
 
 
@@ -91,7 +92,7 @@ class Coordinatord(TailableProc):
             f.write("[bitcoind_config]\n")
             f.write(f"cookie_path = '{bitcoind_cookie_path}'\n")
             f.write(f"addr = '127.0.0.1:{bitcoind_rpc_port}'\n")
-            f.write("broadcast_interval = 5\n")
+            f.write(f"broadcast_interval = {scaled_interval(5)}\n")
 
     def postgres_exec(self, sql):
         conn = psycopg2.connect(
@@ -16,12 +16,19 @@ class Cosignerd(TailableProc):
         bitcoin_priv,
         listen_port,
         managers_noisekeys,
+        write_files=True,
     ):
+        """If {write_files} is False, the datadir is left untouched. This is for
+        driving an already running cosignerd."""
         TailableProc.__init__(self, datadir, verbose=VERBOSE)
         self.conf_file = os.path.join(datadir, "config.toml")
         self.cmd_line = [COSIGNERD_PATH, "--conf", f"{self.conf_file}"]
         self.prefix = "cosignerd"
 
+        # Attaching to a running daemon, its datadir is already set up
+        if not write_files:
+            return
+
         noise_secret_file = os.path.join(datadir, "noise_secret")
         with open(noise_secret_file, "wb") as f:
             f.write(noise_priv)
@@ -1,5 +1,6 @@
 import logging
 import os
+import sqlite3
 import toml
 
 from test_framework.utils import (
@@ -7,10 +8,16 @@ from test_framework.utils import (
     VERBOSE,
     LOG_LEVEL,
     MIRADORD_PATH,
+    scaled_interval,
 )
 from nacl.public import PrivateKey as Curve25519Private
 
 
+# The events parsed from miradord's logs, keyed by Cancel txid or deposit outpoint
+MIRADORD_EVENTS = [
+    ("revault", r"Broadcasting Cancel transaction.*?'(?P<key>[0-9a-f]{64}(?::\d+)?)'"),
+]
+
 # FIXME: it's a bit clumsy. Miradord should stick to be the `miradord` process object
 # and we should have another class (PartialRevaultNetwork?) to stuff helpers and all
 # info not strictly necessary to running the process.
@@ -30,27 +37,34 @@ class Miradord(TailableProc):
         bitcoind_rpcport,
         bitcoind_cookie,
         plugins=[],
+        write_files=True,
     ):
-        """All public keys must be hex"""
+        """All public keys must be hex. If {write_files} is False, the datadir is
+        left untouched. This is for driving an already running miradord."""
         TailableProc.__init__(self, datadir, verbose=VERBOSE)
 
         self.prefix = os.path.split(datadir)[-1]
+        self.events.set_patterns(MIRADORD_EVENTS)
         self.noise_secret = noise_priv
         self.listen_port = listen_port
         self.deposit_desc = deposit_desc
         self.unvault_desc = unvault_desc
         self.cpfp_desc = cpfp_desc
         self.emer_addr = emer_addr
+        self.plugins = plugins
 
-        # The data is stored in a per-network directory. We need to create it
-        # in order to write the Noise private key
+        # The data is stored in a per-network directory
         self.datadir_with_network = os.path.join(datadir, "regtest")
-        os.makedirs(self.datadir_with_network, exist_ok=True)
 
         self.conf_file = os.path.join(datadir, "config.toml")
         self.cmd_line = [MIRADORD_PATH, "--conf", f"{self.conf_file}"]
 
         self.noise_secret_file = os.path.join(self.datadir_with_network, "noise_secret")
+        # Attaching to a running daemon, its datadir is already set up
+        if not write_files:
+            return
+        # We need to create it in order to write the Noise private key
+        os.makedirs(self.datadir_with_network, exist_ok=True)
         with open(self.noise_secret_file, "wb") as f:
             f.write(noise_priv)
         wt_noise_key = bytes(Curve25519Private(noise_priv).public_key)
@@ -67,7 +81,7 @@ class Miradord(TailableProc):
 
             f.write(f'coordinator_host = "127.0.0.1:{coordinator_port}"\n')
             f.write(f'coordinator_noise_key = "{coordinator_noise_key}"\n')
-            f.write("coordinator_poll_seconds = 5\n")
+            f.write(f"coordinator_poll_seconds = {scaled_interval(5)}\n")
 
             f.write(f'listen = "127.0.0.1:{listen_port}"\n')
 
@@ -81,7 +95,7 @@ class Miradord(TailableProc):
             f.write('network = "regtest"\n')
             f.write(f"cookie_path = '{bitcoind_cookie}'\n")
             f.write(f"addr = '127.0.0.1:{bitcoind_rpcport}'\n")
-            f.write("poll_interval_secs = 5\n")
+            f.write(f"poll_interval_secs = {scaled_interval(5)}\n")
 
             f.write(f"\n{toml.dumps({'plugins': plugins})}\n")
 
@@ -91,6 +105,21 @@ class Miradord(TailableProc):
             ["bitcoind now synced", "Listener thread started", "Started miradord."]
         )
 
+    def tip_height(self):
+        """The height of the tip miradord is synced to, read from its database. None
+        if we can't tell."""
+        db_path = os.path.join(self.datadir_with_network, "miradord.sqlite3")
+        try:
+            conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+            try:
+                row = conn.execute("SELECT tip_blockheight FROM instances").fetchone()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logging.debug(f"{self.prefix}: could not read the tip height: '{e}'")
+            return None
+        return row[0] if row is not None else None
+
     def stop(self, timeout=10):
         return TailableProc.stop(self)
 
@@ -108,6 +137,7 @@ class Miradord(TailableProc):
         if "plugins" not in conf:
             conf["plugins"] = []
         conf["plugins"] += plugins
+        self.plugins = conf["plugins"]
         open(self.conf_file, "w").write(toml.dumps(conf))
         self.start()
 
@@ -115,5 +145,6 @@ class Miradord(TailableProc):
         self.stop()
         conf = toml.loads(open(self.conf_file, "r").read())
         conf["plugins"] = [p for p in conf["plugins"] if p["path"] not in plugins_paths]
+        self.plugins = conf["plugins"]
         open(self.conf_file, "w").write(toml.dumps(conf))
         self.start()
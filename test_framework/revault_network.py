@@ -1,27 +1,55 @@
+import asyncio
 import bip32
 import logging
 import os
 import random
+import time
 
+from bip380.descriptors import Descriptor
 from ephemeral_port_reserve import reserve
 from nacl.public import PrivateKey as Curve25519Private
 from test_framework import serializations
-from test_framework.bitcoind import BitcoindRpcProxy
+from test_framework.bitcoind import BitcoinD, BitcoindRpcProxy
 from test_framework.coordinatord import Coordinatord, DummyCoordinator
 from test_framework.cosignerd import Cosignerd
 from test_framework.miradord import Miradord
-from test_framework.revaultd import ManagerRevaultd, StakeholderRevaultd, StkManRevaultd
+from test_framework.revaultd import (
+    ManagerRevaultd,
+    Revaultd,
+    StakeholderRevaultd,
+    StkManRevaultd,
+    VaultsMirror,
+)
 from test_framework.utils import (
     get_descriptors,
     get_participants,
     finalize_input,
     wait_for,
+    RpcError,
+    Cosig,
+    TailableProc,
+    User,
     TIMEOUT,
     WT_PLUGINS_DIR,
     POSTGRES_IS_SETUP,
 )
 
 
+# Bump this whenever the format of the deployment manifest changes
+MANIFEST_VERSION = 1
+# The bounds of the number of blocks generated at once by generate_blocks(), and how
+# long generating and syncing each chunk should take.
+GENERATE_CHUNK_MIN = 12
+GENERATE_CHUNK_MAX = 2016
+GENERATE_CHUNK_SECS = 5
+# How much longer than TIMEOUT to wait for the daemons to sync, per block of a chunk
+GENERATE_SYNC_SECS_PER_BLOCK = 0.5
+
+
+def noise_pubkey(noise_priv):
+    return bytes(Curve25519Private(noise_priv).public_key)
+
+
 class RevaultNetwork:
     # FIXME: we use a single bitcoind for all the wallets because it's much
     # more efficient. Eventually, we may have to test with separate ones.
@@ -33,6 +61,7 @@ class RevaultNetwork:
         postgres_user,
         postgres_pass,
         postgres_host="localhost",
+        coordinator_port=None,
     ):
         self.root_dir = root_dir
         self.bitcoind = bitcoind
@@ -43,7 +72,14 @@ class RevaultNetwork:
         self.postgres_user = postgres_user
         self.postgres_pass = postgres_pass
         self.postgres_host = postgres_host
-        self.coordinator_port = reserve()
+        self.coordinator_port = (
+            coordinator_port if coordinator_port is not None else reserve()
+        )
+        self.coordinator = None
+        # The listening ports of the watchtowers and cosigning servers, by datadir name
+        self.ports = {}
+        # The txid of the Spend transaction of each spent vault, by deposit outpoint
+        self.spend_txids = {}
 
         self.stk_wallets = []
         self.stkman_wallets = []
@@ -51,6 +87,8 @@ class RevaultNetwork:
 
         self.csv = None
         self.emergency_address = None
+        # The keys and configuration of all the participants, see _spawn_daemons()
+        self.layout = None
 
         self.bitcoind_proxy = None
 
@@ -79,16 +117,14 @@ class RevaultNetwork:
         assert n_managers + n_stkmanagers >= 1, "Not enough managers"
         assert managers_threshold <= n_managers + n_stkmanagers, "Invalid threshold"
 
-        # Connection info to bitcoind. Change the port depending on whether we are proxying
-        # the daemons' requests.
-        bitcoind_cookie = os.path.join(self.bitcoind.bitcoin_dir, "regtest", ".cookie")
+        # Connection info to bitcoind. Proxy the daemons' requests if asked to.
         if len(bitcoind_rpc_mocks) > 0:
+            bitcoind_cookie = os.path.join(
+                self.bitcoind.bitcoin_dir, "regtest", ".cookie"
+            )
             self.bitcoind_proxy = BitcoindRpcProxy(
                 self.bitcoind.rpcport, bitcoind_cookie, bitcoind_rpc_mocks
             )
-            bitcoind_rpcport = self.bitcoind_proxy.rpcport
-        else:
-            bitcoind_rpcport = self.bitcoind.rpcport
 
         (
             stkonly_keychains,
@@ -140,60 +176,95 @@ class RevaultNetwork:
         if not desc_import[0]["success"]:
             raise Exception(desc_import)
 
-        # FIXME: this is getting dirty.. We should re-centralize information
-        # about each participant in specified data structures
-        stkonly_cosigners_ports = []
-        stkman_cosigners_ports = []
-
         # The Noise keys are interdependant, so generate everything in advance
         # to avoid roundtrips
-        coordinator_noisepriv = os.urandom(32)
-        coordinator_noisepub = bytes(
-            Curve25519Private(coordinator_noisepriv).public_key
-        )
-
-        (stkonly_noiseprivs, stkonly_noisepubs) = ([], [])
-        (stkonly_wt_noiseprivs, stkonly_wt_noisepubs) = ([], [])
-        (stkonly_cosig_noiseprivs, stkonly_cosig_noisepubs) = ([], [])
-        for i in range(len(stkonly_keychains)):
-            stkonly_noiseprivs.append(os.urandom(32))
-            stkonly_noisepubs.append(
-                bytes(Curve25519Private(stkonly_noiseprivs[i]).public_key)
-            )
-            if with_cosigs:
-                stkonly_cosig_noiseprivs.append(os.urandom(32))
-                stkonly_cosig_noisepubs.append(
-                    bytes(Curve25519Private(stkonly_cosig_noiseprivs[i]).public_key)
-                )
-            # Unused yet
-            stkonly_wt_noiseprivs.append(os.urandom(32))
-            stkonly_wt_noisepubs.append(
-                bytes(Curve25519Private(stkonly_wt_noiseprivs[i]).public_key)
+        self.layout = {
+            "managers_threshold": managers_threshold,
+            "with_cosigs": with_cosigs,
+            "with_watchtowers": with_watchtowers,
+            "with_cpfp": with_cpfp,
+            "coordinator_noise_priv": os.urandom(32),
+            "stakeholders": [],
+            "stkmanagers": [],
+            "managers": [],
+        }
+        for i, stk in enumerate(stkonly_keychains):
+            self.layout["stakeholders"].append(
+                {
+                    "keychain": stk,
+                    "noise_priv": os.urandom(32),
+                    # Unused if not with_watchtowers
+                    "wt_noise_priv": os.urandom(32),
+                    "cosig_keychain": stkonly_cosig_keychains[i]
+                    if with_cosigs
+                    else None,
+                    "cosig_noise_priv": os.urandom(32) if with_cosigs else None,
+                }
             )
-
-        (stkman_noiseprivs, stkman_noisepubs) = ([], [])
-        (stkman_wt_noiseprivs, stkman_wt_noisepubs) = ([], [])
-        (stkman_cosig_noiseprivs, stkman_cosig_noisepubs) = ([], [])
-        for i in range(len(stkman_stk_keychains)):
-            stkman_noiseprivs.append(os.urandom(32))
-            stkman_noisepubs.append(
-                bytes(Curve25519Private(stkman_noiseprivs[i]).public_key)
+        for i, stkman in enumerate(stkman_stk_keychains):
+            self.layout["stkmanagers"].append(
+                {
+                    "keychain": stkman,
+                    "man_keychain": stkman_man_keychains[i],
+                    "noise_priv": os.urandom(32),
+                    # Unused if not with_watchtowers
+                    "wt_noise_priv": os.urandom(32),
+                    "cosig_keychain": stkman_cosig_keychains[i]
+                    if with_cosigs
+                    else None,
+                    "cosig_noise_priv": os.urandom(32) if with_cosigs else None,
+                    "cpfp_seed": stkman_cpfp_seeds[i],
+                }
             )
-            if with_cosigs:
-                stkman_cosig_noiseprivs.append(os.urandom(32))
-                stkman_cosig_noisepubs.append(
-                    bytes(Curve25519Private(stkman_cosig_noiseprivs[i]).public_key)
-                )
-            # Unused yet
-            stkman_wt_noiseprivs.append(os.urandom(32))
-            stkman_wt_noisepubs.append(
-                bytes(Curve25519Private(stkman_wt_noiseprivs[i]).public_key)
+        for i, man in enumerate(manonly_keychains):
+            self.layout["managers"].append(
+                {
+                    "keychain": man,
+                    "noise_priv": os.urandom(32),
+                    "cpfp_seed": man_cpfp_seeds[i],
+                }
             )
 
-        (man_noiseprivs, man_noisepubs) = ([], [])
-        for i in range(len(manonly_keychains)):
-            man_noiseprivs.append(os.urandom(32))
-            man_noisepubs.append(bytes(Curve25519Private(man_noiseprivs[i]).public_key))
+        self._spawn_daemons()
+
+    def _spawn_daemons(self, coordinator_state=None, start=True):
+        """Create the coordinator, the wallets and their servers as described by
+        {self.layout}, and start them concurrently unless {start} is False.
+
+        The datadirs are re-used if they exist already. {coordinator_state} is the
+        state to restore into the dummy coordinator, if any.
+        """
+        with_cosigs = self.layout["with_cosigs"]
+        with_watchtowers = self.layout["with_watchtowers"]
+        with_cpfp = self.layout["with_cpfp"]
+
+        # Connection info to bitcoind. Change the port depending on whether we are proxying
+        # the daemons' requests.
+        bitcoind_cookie = os.path.join(self.bitcoind.bitcoin_dir, "regtest", ".cookie")
+        if self.bitcoind_proxy is not None:
+            bitcoind_rpcport = self.bitcoind_proxy.rpcport
+        else:
+            bitcoind_rpcport = self.bitcoind.rpcport
+
+        coordinator_noisepriv = self.layout["coordinator_noise_priv"]
+        coordinator_noisepub = noise_pubkey(coordinator_noisepriv)
+        stakeholders = self.layout["stakeholders"]
+        stkmanagers = self.layout["stkmanagers"]
+        managers = self.layout["managers"]
+        stkonly_noisepubs = [noise_pubkey(stk["noise_priv"]) for stk in stakeholders]
+        stkonly_wt_noisepubs = [noise_pubkey(s["wt_noise_priv"]) for s in stakeholders]
+        stkman_noisepubs = [noise_pubkey(stk["noise_priv"]) for stk in stkmanagers]
+        stkman_wt_noisepubs = [noise_pubkey(s["wt_noise_priv"]) for s in stkmanagers]
+        man_noisepubs = [noise_pubkey(man["noise_priv"]) for man in managers]
+        if with_cosigs:
+            stkonly_cosig_noisepubs = [
+                noise_pubkey(stk["cosig_noise_priv"]) for stk in stakeholders
+            ]
+            stkman_cosig_noisepubs = [
+                noise_pubkey(stk["cosig_noise_priv"]) for stk in stkmanagers
+            ]
+        else:
+            stkonly_cosig_noisepubs, stkman_cosig_noisepubs = [], []
 
         logging.debug(
             f"Using Noise pubkeys:\n- Stakeholders: {stkonly_noisepubs + stkman_noisepubs}"
@@ -204,7 +275,10 @@ class RevaultNetwork:
 
         # If they filled information about a Postgre backend, use the real coordinator.
         # Otherwise use the dummy one.
-        if POSTGRES_IS_SETUP:
+        if not start:
+            pass
+        elif POSTGRES_IS_SETUP:
+            assert coordinator_state is None, "Can't restore coordinatord's database"
             coord_datadir = os.path.join(self.root_dir, "coordinatord")
             os.makedirs(coord_datadir, exist_ok=True)
             coordinatord = Coordinatord(
@@ -221,6 +295,7 @@ class RevaultNetwork:
                 self.postgres_host,
             )
             coordinatord.start()
+            self.coordinator = coordinatord
             self.daemons.append(coordinatord)
         else:
             coordinator = DummyCoordinator(
@@ -232,23 +307,25 @@ class RevaultNetwork:
                 + stkonly_wt_noisepubs
                 + stkman_wt_noisepubs,
             )
+            if coordinator_state is not None:
+                coordinator.sigs = coordinator_state["sigs"]
+                coordinator.spend_txs = coordinator_state["spend_txs"]
             coordinator.start()
+            self.coordinator = coordinator
             self.daemons.append(coordinator)
 
         cosigners_info = []
         for (i, noisepub) in enumerate(stkonly_cosig_noisepubs):
-            stkonly_cosigners_ports.append(reserve())
             cosigners_info.append(
                 {
-                    "host": f"127.0.0.1:{stkonly_cosigners_ports[i]}",
+                    "host": f"127.0.0.1:{self._port(f'cosignerd-stk-{i}')}",
                     "noise_key": noisepub,
                 }
             )
         for (i, noisepub) in enumerate(stkman_cosig_noisepubs):
-            stkman_cosigners_ports.append(reserve())
             cosigners_info.append(
                 {
-                    "host": f"127.0.0.1:{stkman_cosigners_ports[i]}",
+                    "host": f"127.0.0.1:{self._port(f'cosignerd-stkman-{i}')}",
                     "noise_key": noisepub,
                 }
             )
@@ -262,11 +339,12 @@ class RevaultNetwork:
         }
 
         # Spin up the stakeholders wallets and their cosigning servers
-        for i, stk in enumerate(stkonly_keychains):
+        for i, stk in enumerate(stakeholders):
             if with_watchtowers:
                 datadir = os.path.join(self.root_dir, f"miradord-{i}")
-                os.makedirs(datadir)
-                wt_listen_port = reserve()
+                if start:
+                    os.makedirs(datadir, exist_ok=True)
+                wt_listen_port = self._port(f"miradord-{i}")
                 miradord = Miradord(
                     datadir,
                     str(self.deposit_desc),
@@ -274,21 +352,24 @@ class RevaultNetwork:
                     str(self.cpfp_desc),
                     self.emergency_address,
                     wt_listen_port,
-                    stkonly_wt_noiseprivs[i],
+                    stk["wt_noise_priv"],
                     stkonly_noisepubs[i].hex(),
                     coordinator_noisepub.hex(),
                     self.coordinator_port,
                     bitcoind_rpcport,
                     bitcoind_cookie,
-                    plugins=[default_wt_plugin],
+                    plugins=stk.get("wt_plugins", [default_wt_plugin]),
+                    write_files=start,
                 )
-                start_jobs.append(self.executor.submit(miradord.start))
+                if start:
+                    start_jobs.append(self.executor.submit(miradord.start))
                 self.daemons.append(miradord)
 
             datadir = os.path.join(self.root_dir, f"revaultd-stk-{i}")
-            os.makedirs(datadir, exist_ok=True)
+            if start:
+                os.makedirs(datadir, exist_ok=True)
             stk_config = {
-                "keychain": stk,
+                "keychain": stk["keychain"],
                 "watchtowers": [
                     {
                         "host": f"127.0.0.1:{wt_listen_port}",
@@ -305,37 +386,43 @@ class RevaultNetwork:
                 str(self.deposit_desc),
                 str(self.unvault_desc),
                 str(self.cpfp_desc),
-                stkonly_noiseprivs[i],
+                stk["noise_priv"],
                 coordinator_noisepub.hex(),
                 self.coordinator_port,
                 bitcoind_rpcport,
                 bitcoind_cookie,
                 stk_config,
                 wt_process=miradord if with_watchtowers else None,
+                write_files=start,
             )
-            start_jobs.append(self.executor.submit(revaultd.start))
+            if start:
+                start_jobs.append(self.executor.submit(revaultd.start))
             self.stk_wallets.append(revaultd)
 
             if with_cosigs:
                 datadir = os.path.join(self.root_dir, f"cosignerd-stk-{i}")
-                os.makedirs(datadir, exist_ok=True)
+                if start:
+                    os.makedirs(datadir, exist_ok=True)
 
                 cosignerd = Cosignerd(
                     datadir,
-                    stkonly_cosig_noiseprivs[i],
-                    stkonly_cosig_keychains[i].get_bitcoin_priv(),
-                    stkonly_cosigners_ports[i],
+                    stk["cosig_noise_priv"],
+                    stk["cosig_keychain"].get_bitcoin_priv(),
+                    self._port(f"cosignerd-stk-{i}"),
                     man_noisepubs + stkman_noisepubs,
+                    write_files=start,
                 )
-                start_jobs.append(self.executor.submit(cosignerd.start))
+                if start:
+                    start_jobs.append(self.executor.submit(cosignerd.start))
                 self.daemons.append(cosignerd)
 
         # Spin up the stakeholder-managers wallets and their cosigning servers
-        for i, stkman in enumerate(stkman_stk_keychains):
+        for i, stkman in enumerate(stkmanagers):
             if with_watchtowers:
                 datadir = os.path.join(self.root_dir, f"miradord-stkman-{i}")
-                os.makedirs(datadir)
-                wt_listen_port = reserve()
+                if start:
+                    os.makedirs(datadir, exist_ok=True)
+                wt_listen_port = self._port(f"miradord-stkman-{i}")
                 miradord = Miradord(
                     datadir,
                     str(self.deposit_desc),
@@ -343,21 +430,24 @@ class RevaultNetwork:
                     str(self.cpfp_desc),
                     self.emergency_address,
                     wt_listen_port,
-                    stkman_wt_noiseprivs[i],
+                    stkman["wt_noise_priv"],
                     stkman_noisepubs[i].hex(),
                     coordinator_noisepub.hex(),
                     self.coordinator_port,
                     bitcoind_rpcport,
                     bitcoind_cookie,
-                    plugins=[default_wt_plugin],
+                    plugins=stkman.get("wt_plugins", [default_wt_plugin]),
+                    write_files=start,
                 )
-                start_jobs.append(self.executor.submit(miradord.start))
+                if start:
+                    start_jobs.append(self.executor.submit(miradord.start))
                 self.daemons.append(miradord)
 
             datadir = os.path.join(self.root_dir, f"revaultd-stkman-{i}")
-            os.makedirs(datadir, exist_ok=True)
+            if start:
+                os.makedirs(datadir, exist_ok=True)
             stk_config = {
-                "keychain": stkman,
+                "keychain": stkman["keychain"],
                 "watchtowers": [
                     {
                         "host": f"127.0.0.1:{wt_listen_port}",
@@ -369,7 +459,7 @@ class RevaultNetwork:
                 "emergency_address": self.emergency_address,
             }
             man_config = {
-                "keychain": stkman_man_keychains[i],
+                "keychain": stkman["man_keychain"],
                 "cosigners": cosigners_info,
             }
 
@@ -378,7 +468,7 @@ class RevaultNetwork:
                 str(self.deposit_desc),
                 str(self.unvault_desc),
                 str(self.cpfp_desc),
-                stkman_noiseprivs[i],
+                stkman["noise_priv"],
                 coordinator_noisepub.hex(),
                 self.coordinator_port,
                 bitcoind_rpcport,
@@ -386,45 +476,53 @@ class RevaultNetwork:
                 stk_config,
                 man_config,
                 wt_process=miradord if with_watchtowers else None,
-                cpfp_seed=stkman_cpfp_seeds[i] if with_cpfp else None,
+                cpfp_seed=stkman["cpfp_seed"] if with_cpfp else None,
+                write_files=start,
             )
-            start_jobs.append(self.executor.submit(revaultd.start))
+            if start:
+                start_jobs.append(self.executor.submit(revaultd.start))
             self.stkman_wallets.append(revaultd)
 
             if with_cosigs:
                 datadir = os.path.join(self.root_dir, f"cosignerd-stkman-{i}")
-                os.makedirs(datadir, exist_ok=True)
+                if start:
+                    os.makedirs(datadir, exist_ok=True)
 
                 cosignerd = Cosignerd(
                     datadir,
-                    stkman_cosig_noiseprivs[i],
-                    stkman_cosig_keychains[i].get_bitcoin_priv(),
-                    stkman_cosigners_ports[i],
+                    stkman["cosig_noise_priv"],
+                    stkman["cosig_keychain"].get_bitcoin_priv(),
+                    self._port(f"cosignerd-stkman-{i}"),
                     man_noisepubs + stkman_noisepubs,
+                    write_files=start,
                 )
-                start_jobs.append(self.executor.submit(cosignerd.start))
+                if start:
+                    start_jobs.append(self.executor.submit(cosignerd.start))
                 self.daemons.append(cosignerd)
 
         # Spin up the managers (only) wallets
-        for i, man in enumerate(manonly_keychains):
+        for i, man in enumerate(managers):
             datadir = os.path.join(self.root_dir, f"revaultd-man-{i}")
-            os.makedirs(datadir, exist_ok=True)
+            if start:
+                os.makedirs(datadir, exist_ok=True)
 
-            man_config = {"keychain": man, "cosigners": cosigners_info}
+            man_config = {"keychain": man["keychain"], "cosigners": cosigners_info}
             daemon = ManagerRevaultd(
                 datadir,
                 str(self.deposit_desc),
                 str(self.unvault_desc),
                 str(self.cpfp_desc),
-                man_noiseprivs[i],
+                man["noise_priv"],
                 coordinator_noisepub.hex(),
                 self.coordinator_port,
                 bitcoind_rpcport,
                 bitcoind_cookie,
                 man_config,
-                cpfp_seed=man_cpfp_seeds[i] if with_cpfp else None,
+                cpfp_seed=man["cpfp_seed"] if with_cpfp else None,
+                write_files=start,
             )
-            start_jobs.append(self.executor.submit(daemon.start))
+            if start:
+                start_jobs.append(self.executor.submit(daemon.start))
             self.man_wallets.append(daemon)
 
         for j in start_jobs:
@@ -432,6 +530,191 @@ class RevaultNetwork:
 
         self.daemons += self.stk_wallets + self.stkman_wallets + self.man_wallets
 
+    def _port(self, name):
+        """Get the listening port of this server, reserving it if necessary."""
+        if name not in self.ports:
+            self.ports[name] = reserve()
+        return self.ports[name]
+
+    @classmethod
+    def attach(cls, manifest, executor):
+        """Get a RevaultNetwork driving the running deployment described by this
+        {manifest} (see manifest()), for instance from another process.
+
+        Nothing is started, and nothing is written to the datadirs nor are ports
+        reserved: the wallets, watchtowers and cosigning servers are only re-created
+        to talk to the running daemons. Don't cleanup() it, the processes are owned
+        by whoever deployed them.
+        """
+        bitcoind = BitcoinD(
+            manifest["bitcoind"]["datadir"],
+            manifest["bitcoind"]["rpcport"],
+            p2pport=manifest["bitcoind"]["p2pport"],
+            write_files=False,
+        )
+        rn = cls(
+            manifest["root_dir"],
+            bitcoind,
+            executor,
+            None,
+            None,
+            coordinator_port=manifest["coordinator_port"],
+        )
+        rn._load_manifest(manifest)
+        rn.ports = manifest["ports"]
+        rn._spawn_daemons(start=False)
+        return rn
+
+    def manifest(self):
+        """Get a JSON-serializable description of this deployment, from which it
+        can be restored or attached to. This includes all the private keys.
+
+        For restoring, call this once the daemons are stopped for the coordinator
+        state to be consistent with the wallets'.
+        """
+        assert self.layout is not None, "You must have deploy()ed first"
+
+        def serialize(entry, wallet):
+            res = {}
+            for k, v in entry.items():
+                if isinstance(v, (User, Cosig)):
+                    v = v.hd.get_xpriv()
+                elif isinstance(v, bytes):
+                    v = v.hex()
+                res[k] = v
+            if wallet.watchtower is not None:
+                res["wt_plugins"] = wallet.watchtower.plugins
+            return res
+
+        layout = {
+            k: v for k, v in self.layout.items() if not isinstance(v, (list, bytes))
+        }
+        layout["coordinator_noise_priv"] = self.layout["coordinator_noise_priv"].hex()
+        layout["stakeholders"] = [
+            serialize(e, w) for e, w in zip(self.layout["stakeholders"], self.stk_wallets)
+        ]
+        layout["stkmanagers"] = [
+            serialize(e, w)
+            for e, w in zip(self.layout["stkmanagers"], self.stkman_wallets)
+        ]
+        layout["managers"] = [
+            serialize(e, w) for e, w in zip(self.layout["managers"], self.man_wallets)
+        ]
+
+        coordinator_state = None
+        if isinstance(self.coordinator, DummyCoordinator):
+            coordinator_state = {
+                "sigs": self.coordinator.sigs,
+                "spend_txs": self.coordinator.spend_txs,
+            }
+
+        # Informational, for external tools to find and monitor the daemons
+        processes = {}
+        for d in self.daemons:
+            if not isinstance(d, TailableProc):
+                continue
+            proc = {
+                "datadir": d.outputDir,
+                "pid": d.proc.pid
+                if d.proc is not None and d.proc.poll() is None
+                else None,
+            }
+            if isinstance(d, Revaultd):
+                proc["rpc_socket"] = d.rpc.socket_path
+            processes[d.prefix] = proc
+        layout["xpubs"] = {
+            "stakeholders": [
+                stk.stk_keychain.get_xpub()
+                for stk in self.stk_wallets + self.stkman_wallets
+            ],
+            "managers": [man.man_keychain.get_xpub() for man in self.mans()],
+            "cosigners": [
+                e["cosig_keychain"].get_static_key().hex()
+                for e in self.layout["stakeholders"] + self.layout["stkmanagers"]
+                if e["cosig_keychain"] is not None
+            ],
+        }
+        layout["noise_pubkeys"] = {
+            "coordinator": noise_pubkey(self.layout["coordinator_noise_priv"]).hex(),
+            **{
+                w.prefix: noise_pubkey(e["noise_priv"]).hex()
+                for e, w in zip(
+                    self.layout["stakeholders"]
+                    + self.layout["stkmanagers"]
+                    + self.layout["managers"],
+                    self.stk_wallets + self.stkman_wallets + self.man_wallets,
+                )
+            },
+        }
+
+        return {
+            "version": MANIFEST_VERSION,
+            "root_dir": self.root_dir,
+            "bitcoind": {
+                "datadir": self.bitcoind.bitcoin_dir,
+                "rpcport": self.bitcoind.rpcport,
+                "p2pport": self.bitcoind.p2pport,
+                "pid": self.bitcoind.proc.pid
+                if self.bitcoind.proc is not None and self.bitcoind.proc.poll() is None
+                else None,
+            },
+            "processes": processes,
+            "csv": self.csv,
+            "deposit_descriptor": str(self.deposit_desc),
+            "unvault_descriptor": str(self.unvault_desc),
+            "cpfp_descriptor": str(self.cpfp_desc),
+            "emergency_address": self.emergency_address,
+            "layout": layout,
+            "coordinator_port": self.coordinator_port,
+            "ports": self.ports,
+            "coordinator_state": coordinator_state,
+        }
+
+    def _load_manifest(self, manifest):
+        """Set the deployment description from a manifest() output."""
+        if manifest["version"] != MANIFEST_VERSION:
+            raise ValueError(
+                f"Unsupported manifest version '{manifest['version']}', expected"
+                f" '{MANIFEST_VERSION}'"
+            )
+        self.csv = manifest["csv"]
+        self.deposit_desc = Descriptor.from_str(manifest["deposit_descriptor"])
+        self.unvault_desc = Descriptor.from_str(manifest["unvault_descriptor"])
+        self.cpfp_desc = Descriptor.from_str(manifest["cpfp_descriptor"])
+        self.emergency_address = manifest["emergency_address"]
+
+        def deserialize(entry):
+            res = {}
+            for k, v in entry.items():
+                if v is not None and k in ["keychain", "man_keychain"]:
+                    v = User(v)
+                elif v is not None and k == "cosig_keychain":
+                    v = Cosig(v)
+                elif v is not None and k.endswith(("_priv", "_seed")):
+                    v = bytes.fromhex(v)
+                res[k] = v
+            return res
+
+        layout = manifest["layout"]
+        self.layout = {
+            k: v for k, v in layout.items() if k not in ["xpubs", "noise_pubkeys"]
+        }
+        self.layout["coordinator_noise_priv"] = bytes.fromhex(
+            layout["coordinator_noise_priv"]
+        )
+        for participants in ["stakeholders", "stkmanagers", "managers"]:
+            self.layout[participants] = [deserialize(e) for e in layout[participants]]
+
+    def restore(self, manifest):
+        """Restore the deployment described by this {manifest} (see manifest()),
+        re-using the existing datadirs but with newly reserved ports.
+
+        Restoring the state of the coordinator is only supported with the dummy one.
+        """
+        assert len(self.daemons) == 0, "Already deployed"
+        self._load_manifest(manifest)
+        self._spawn_daemons(coordinator_state=manifest["coordinator_state"])
+
     def mans(self):
         return self.stkman_wallets + self.man_wallets
 
@@ -441,6 +724,9 @@ class RevaultNetwork:
     def participants(self):
         return self.stkman_wallets + self.stk_wallets + self.man_wallets
 
+    def watchtowers(self):
+        return [d for d in self.daemons if isinstance(d, Miradord)]
+
     def man(self, n):
         """Get the {n}th manager (including the stakeholder-managers first)"""
         mans = self.stkman_wallets + self.man_wallets
@@ -451,6 +737,108 @@ class RevaultNetwork:
         stks = self.stkman_wallets + self.stk_wallets
         return stks[n]
 
+    def wait_for_vaults(self, expectations, timeout=TIMEOUT):
+        """Wait for all these (wallet, statuses, outpoints) {expectations} to hold:
+        each of the {outpoints} must be in one of the {statuses} for this {wallet}.
+
+        This is served from the wallets' vaults mirrors, which are polled
+        concurrently in the background. Raises a TimeoutError listing the unmet
+        expectations, as fetched after the timeout, on timeout.
+        """
+        # wallet -> outpoint -> acceptable statuses
+        pending = {}
+        for w, statuses, outpoints in expectations:
+            assert isinstance(outpoints, list)
+            for outpoint in outpoints:
+                pending.setdefault(w, {}).setdefault(outpoint, set()).update(statuses)
+
+        def all_there(outpoints):
+            return lambda vaults: all(
+                vaults.get(o, {}).get("status") in statuses
+                for o, statuses in outpoints.items()
+            )
+
+        try:
+            VaultsMirror.wait_for_all(
+                [
+                    (w.mirror, all_there(outpoints), list(outpoints))
+                    for w, outpoints in pending.items()
+                ],
+                timeout,
+            )
+            return
+        except TimeoutError:
+            pass
+
+        # The mirrors may lag behind, report the current statuses
+        missing = []
+        for w, outpoints in pending.items():
+            try:
+                vaults = {
+                    f"{v['txid']}:{v['vout']}": v
+                    for v in w.rpc.listvaults([], list(outpoints))["vaults"]
+                }
+            except Exception as e:
+                missing.append(f"{w.prefix}: could not list vaults: '{e}'")
+                continue
+            for outpoint, statuses in outpoints.items():
+                status = vaults.get(outpoint, {}).get("status")
+                if status not in statuses:
+                    missing.append(
+                        f"{w.prefix}: '{outpoint}' is {status or 'unknown'}, not in "
+                        f"{sorted(statuses)}"
+                    )
+        raise TimeoutError(
+            "Timed out waiting for vaults statuses:\n" + "\n".join(missing)
+        )
+
+    def wait_for_synced(self, height, timeout=TIMEOUT):
+        """Wait for all the wallets and watchtowers to be synced to {height}"""
+
+        def synced():
+            for w in self.participants():
+                if w.rpc.getinfo()["blockheight"] < height:
+                    return False
+            for wt in self.watchtowers():
+                # We can't tell until it created its database
+                tip = wt.tip_height()
+                if tip is None or tip < height:
+                    return False
+            return True
+
+        wait_for(synced, timeout=timeout)
+
+    def generate_blocks(self, n):
+        """Generate {n} blocks by chunks, waiting for all the daemons to be synced to
+        the new tip before generating the next one.
+
+        The size of the chunks is adapted for each of them to take about
+        GENERATE_CHUNK_SECS, so this works for large timelocks too.
+        """
+        start_height = self.bitcoind.rpc.getblockcount()
+        chunk = GENERATE_CHUNK_MIN
+        done = 0
+        start_time = time.monotonic()
+        while done < n:
+            chunk = min(chunk, n - done)
+            chunk_start = time.monotonic()
+            self.bitcoind.generate_block(chunk)
+            done += chunk
+            self.wait_for_synced(
+                start_height + done,
+                timeout=TIMEOUT + chunk * GENERATE_SYNC_SECS_PER_BLOCK,
+            )
+
+            elapsed = time.monotonic() - chunk_start
+            rate = chunk / max(elapsed, 0.001)
+            chunk = int(rate * GENERATE_CHUNK_SECS)
+            chunk = max(GENERATE_CHUNK_MIN, min(chunk, GENERATE_CHUNK_MAX))
+            if n > GENERATE_CHUNK_MIN:
+                total_elapsed = time.monotonic() - start_time
+                logging.info(
+                    f"Generated {done}/{n} blocks ({done / total_elapsed:.0f} blocks/s)"
+                )
+
     def signed_unvault_psbt(self, deposit, derivation_index):
         """Get the fully-signed Unvault transaction for this deposit.
 
@@ -481,6 +869,40 @@ class RevaultNetwork:
         psbt.tx.wit.vtxinwit.append(psbt.inputs[0].final_script_witness)
         return psbt.tx.serialize_with_witness().hex()
 
+    def vault_timeline(self, vault):
+        """The events related to this {vault} parsed from the logs of all the daemons,
+        in order. Each comes with the time elapsed since the first one."""
+        deposit = f"{vault['txid']}:{vault['vout']}"
+        keys = {deposit}
+        if deposit in self.spend_txids:
+            keys.add(self.spend_txids[deposit])
+        try:
+            presigned = self.stk(0).rpc.listpresignedtransactions([deposit])[
+                "presigned_transactions"
+            ][0]
+            for name in ["unvault", "cancel"]:
+                psbt = serializations.PSBT()
+                psbt.deserialize(presigned[name])
+                psbt.tx.calc_sha256()
+                keys.add(psbt.tx.hash)
+        except RpcError:
+            # Not secured yet
+            pass
+
+        events = sorted(
+            (e for d in self.daemons for e in d.events.timeline(keys)),
+            key=lambda e: e.time,
+        )
+        return [
+            {
+                "event": e.kind,
+                "daemon": e.prefix,
+                "time": e.time,
+                "elapsed": e.time - events[0].time,
+            }
+            for e in events
+        ]
+
     def get_vault(self, address):
         """Get a vault entry by outpoint or by address"""
         for v in self.man(0).rpc.listvaults()["vaults"]:
@@ -501,19 +923,43 @@ class RevaultNetwork:
 
         addr = man.rpc.getdepositaddress()["address"]
         txid = self.bitcoind.rpc.sendtoaddress(addr, amount)
-        man.wait_for_log(f"Got a new unconfirmed deposit at {txid}")
+        deposits = self._deposit_outpoints(txid, [addr])
+        self._wait_for_deposits_events(man, deposits, "deposit_seen", "unconfirmed")
         self.bitcoind.generate_block(6, wait_for_mempool=txid)
-        man.wait_for_log(f"Vault at {txid}.* is now confirmed")
+        self._wait_for_deposits_events(man, deposits, "vault_confirmed", "funded")
 
         vaults = man.rpc.listvaults(["funded"])["vaults"]
         for v in vaults:
             if v["txid"] == txid:
-                for w in self.man_wallets + self.stk_wallets:
-                    w.wait_for_deposits([f"{txid}:{v['vout']}"])
+                deposit = f"{txid}:{v['vout']}"
+                self.wait_for_vaults(
+                    [(w, ["funded"], [deposit]) for w in self.man_wallets + self.stk_wallets]
+                )
                 return v
 
         raise Exception(f"Vault created by '{txid}' got in logs but not in listvaults?")
 
+    def _deposit_outpoints(self, txid, addresses):
+        """The outpoints of the outputs of {txid} paying to these deposit
+        {addresses}"""
+        details = self.bitcoind.rpc.gettransaction(txid)["details"]
+        return [
+            f"{txid}:{d['vout']}"
+            for d in details
+            if d["category"] == "send" and d["address"] in addresses
+        ]
+
+    def _wait_for_deposits_events(self, w, deposits, kind, status, timeout=TIMEOUT):
+        """Wait for {w} to log the event {kind} for each of the {deposits} outpoints.
+        If we did not start {w} (see attach()), poll for them to be in {status}
+        instead."""
+        if w.proc is None:
+            w.mirror.wait_for_statuses([status], deposits, timeout)
+            return
+        deadline = time.monotonic() + timeout
+        for deposit in deposits:
+            w.events.wait_for(kind, deposit, max(deadline - time.monotonic(), 0))
+
     def fundmany(self, amounts=[]):
         """Deposit coins into the architectures in a single transaction"""
         assert (
@@ -530,18 +976,27 @@ class RevaultNetwork:
                 curr_index = v["derivation_index"]
 
         indexes = list(range(curr_index + 1, curr_index + 1 + len(amounts)))
+        addresses = man.rpc.pipeline([("getdepositaddress", [i]) for i in indexes])
         amounts_sendmany = {}
-        for i, amount in enumerate(amounts):
-            amounts_sendmany[man.rpc.getdepositaddress(indexes[i])["address"]] = amount
+        for addr, amount in zip(addresses, amounts):
+            amounts_sendmany[addr["address"]] = amount
 
         txid = self.bitcoind.rpc.sendmany("", amounts_sendmany)
-        man.wait_for_logs(
-            [f"Got a new unconfirmed deposit at {txid}" for _ in range(len(amounts))],
+        deposits = self._deposit_outpoints(txid, list(amounts_sendmany))
+        assert len(deposits) == len(amounts)
+        self._wait_for_deposits_events(
+            man,
+            deposits,
+            "deposit_seen",
+            "unconfirmed",
             timeout=TIMEOUT * max(1, len(amounts) / 10),
         )
         self.bitcoind.generate_block(6, wait_for_mempool=txid)
-        man.wait_for_logs(
-            [f"Vault at {txid}.* is now confirmed" for _ in range(len(amounts))],
+        self._wait_for_deposits_events(
+            man,
+            deposits,
+            "vault_confirmed",
+            "funded",
             timeout=TIMEOUT * max(1, len(amounts) / 10),
         )
 
@@ -558,8 +1013,8 @@ class RevaultNetwork:
     def secure_vault(self, vault):
         """Make all stakeholders share signatures for all revocation txs"""
         deposit = f"{vault['txid']}:{vault['vout']}"
+        self.wait_for_vaults([(stk, ["funded"], [deposit]) for stk in self.stks()])
         for stk in self.stks():
-            stk.wait_for_deposits([deposit])
             psbts = stk.rpc.getrevocationtxs(deposit)
             cancel_psbt = stk.stk_keychain.sign_revocation_psbt(
                 psbts["cancel_tx"], vault["derivation_index"]
@@ -571,8 +1026,7 @@ class RevaultNetwork:
                 psbts["emergency_unvault_tx"], vault["derivation_index"]
             )
             stk.rpc.revocationtxs(deposit, cancel_psbt, emer_psbt, unemer_psbt)
-        for w in self.participants():
-            w.wait_for_secured_vaults([deposit])
+        self.wait_for_vaults([(w, ["secured"], [deposit]) for w in self.participants()])
 
     def secure_vaults(self, vaults):
         """Secure all these vaults, concurrently."""
@@ -585,27 +1039,106 @@ class RevaultNetwork:
     def activate_vault(self, vault):
         """Make all stakeholders share signatures for the unvault tx"""
         deposit = f"{vault['txid']}:{vault['vout']}"
+        self.wait_for_vaults([(stk, ["secured"], [deposit]) for stk in self.stks()])
         for stk in self.stks():
-            stk.wait_for_secured_vaults([deposit])
             unvault_psbt = stk.rpc.getunvaulttx(deposit)["unvault_tx"]
             unvault_psbt = stk.stk_keychain.sign_unvault_psbt(
                 unvault_psbt, vault["derivation_index"]
             )
             stk.rpc.unvaulttx(deposit, unvault_psbt)
-        for w in self.participants():
-            w.wait_for_active_vaults([deposit])
+        self.wait_for_vaults([(w, ["active"], [deposit]) for w in self.participants()])
+
+    def activate_vaults(self, vaults):
+        """Activate all these secured vaults, concurrently."""
+        act_jobs = []
+        for v in vaults:
+            act_jobs.append(self.executor.submit(self.activate_vault, v))
+        for j in act_jobs:
+            j.result(TIMEOUT)
 
     def activate_fresh_vaults(self, vaults):
         """Secure then activate all these vaults, concurrently."""
         # TODO: i'm sure we don't even need to wait for all sec jobs to be complete
         # before starting the activate_vault futures, given a high enough TIMEOUT.
         self.secure_vaults(vaults)
+        self.activate_vaults(vaults)
 
-        act_jobs = []
-        for v in vaults:
-            act_jobs.append(self.executor.submit(self.activate_vault, v))
-        for j in act_jobs:
-            j.result(TIMEOUT)
+    async def secure_vault_async(self, vault):
+        """Same as secure_vault, from an event loop"""
+        deposit = f"{vault['txid']}:{vault['vout']}"
+        for stk in self.stks():
+            await stk.wait_for_deposits_async([deposit])
+            psbts = await stk.arpc.getrevocationtxs(deposit)
+            cancel_psbt = stk.stk_keychain.sign_revocation_psbt(
+                psbts["cancel_tx"], vault["derivation_index"]
+            )
+            emer_psbt = stk.stk_keychain.sign_revocation_psbt(
+                psbts["emergency_tx"], vault["derivation_index"]
+            )
+            unemer_psbt = stk.stk_keychain.sign_revocation_psbt(
+                psbts["emergency_unvault_tx"], vault["derivation_index"]
+            )
+            await stk.arpc.revocationtxs(deposit, cancel_psbt, emer_psbt, unemer_psbt)
+        await asyncio.gather(
+            *(w.wait_for_secured_vaults_async([deposit]) for w in self.participants())
+        )
+
+    async def secure_vaults_async(self, vaults):
+        """Secure all these vaults, concurrently on the running event loop."""
+        await asyncio.wait_for(
+            asyncio.gather(*(self.secure_vault_async(v) for v in vaults)), TIMEOUT
+        )
+
+    async def activate_vault_async(self, vault):
+        """Same as activate_vault, from an event loop"""
+        deposit = f"{vault['txid']}:{vault['vout']}"
+        for stk in self.stks():
+            await stk.wait_for_secured_vaults_async([deposit])
+            unvault_psbt = (await stk.arpc.getunvaulttx(deposit))["unvault_tx"]
+            unvault_psbt = stk.stk_keychain.sign_unvault_psbt(
+                unvault_psbt, vault["derivation_index"]
+            )
+            await stk.arpc.unvaulttx(deposit, unvault_psbt)
+        await asyncio.gather(
+            *(w.wait_for_active_vaults_async([deposit]) for w in self.participants())
+        )
+
+    async def activate_vaults_async(self, vaults):
+        """Activate all these secured vaults, concurrently on the running event loop."""
+        await asyncio.wait_for(
+            asyncio.gather(*(self.activate_vault_async(v) for v in vaults)), TIMEOUT
+        )
+
+    async def activate_fresh_vaults_async(self, vaults):
+        """Secure then activate all these vaults, concurrently on the running event
+        loop."""
+        await self.secure_vaults_async(vaults)
+        await self.activate_vaults_async(vaults)
+
+    async def cancel_vault_async(self, vault):
+        """Same as cancel_vault, from an event loop"""
+        deposit = f"{vault['txid']}:{vault['vout']}"
+
+        await asyncio.gather(
+            *(
+                w.wait_for_vaults_async(
+                    ["unvaulting", "unvaulted", "spending"], [deposit]
+                )
+                for w in self.participants()
+            )
+        )
+
+        await self.stk(0).arpc.revault(deposit)
+        # bitcoind's RPC client is blocking
+        await asyncio.get_running_loop().run_in_executor(
+            self.executor, lambda: self.bitcoind.generate_block(1, wait_for_mempool=1)
+        )
+        await asyncio.gather(
+            *(
+                w.wait_for_vaults_async(["canceled"], [deposit])
+                for w in self.participants()
+            )
+        )
 
     def broadcast_unvaults(self, vaults, destinations, feerate, priority=False):
         """
@@ -640,19 +1173,14 @@ class RevaultNetwork:
         spend_psbt = self.broadcast_unvaults(vaults, destinations, feerate, priority)
         deposits = [f"{v['txid']}:{v['vout']}" for v in vaults]
         self.bitcoind.generate_block(1, wait_for_mempool=len(deposits))
-        for w in self.participants():
-            wait_for(
-                lambda: len(w.rpc.listvaults(["unvaulted"], deposits)["vaults"])
-                == len(deposits)
-            )
+        self.wait_for_vaults([(w, ["unvaulted"], deposits) for w in self.participants()])
         return spend_psbt
 
     def spend_vaults_unconfirmed(self, vaults, destinations, feerate, priority=False):
         """
         Spend these {vaults} to these {destinations} (mapping of addresses to amounts), not
         confirming the Spend transaction.
-        Make sure to call this only with revault deployment with a low (<500) CSV, or you'll encounter
-        an ugly timeout from bitcoinlib.
+        This generates CSV blocks, so it takes longer with large timelocks.
 
         :return: the list of spent deposits along with the Spend PSBT.
         """
@@ -664,8 +1192,7 @@ class RevaultNetwork:
             deposits.append(f"{v['txid']}:{v['vout']}")
             deriv_indexes.append(v["derivation_index"])
 
-        for man in self.mans():
-            man.wait_for_active_vaults(deposits)
+        self.wait_for_vaults([(m, ["active"], deposits) for m in self.mans()])
 
         spend_tx = man.rpc.getspendtx(deposits, destinations, feerate)["spend_tx"]
         for man in self.mans():
@@ -678,23 +1205,21 @@ class RevaultNetwork:
         man.rpc.setspendtx(spend_psbt.tx.hash, priority)
 
         self.bitcoind.generate_block(1, wait_for_mempool=len(deposits))
-        self.bitcoind.generate_block(self.csv)
-        man.wait_for_log(
-            f"Succesfully broadcasted Spend tx '{spend_psbt.tx.hash}'",
-        )
-        for w in self.participants():
-            wait_for(
-                lambda: len(w.rpc.listvaults(["spending"], deposits)["vaults"])
-                == len(deposits)
-            )
+        self.generate_blocks(self.csv)
+        # If we did not start it we can't tail its logs, but we wait for the vaults
+        # to be 'spending' below anyways
+        if man.proc is not None:
+            man.events.wait_for("spend_broadcast", spend_psbt.tx.hash)
+        for deposit in deposits:
+            self.spend_txids[deposit] = spend_psbt.tx.hash
+        self.wait_for_vaults([(w, ["spending"], deposits) for w in self.participants()])
 
         return deposits, spend_psbt
 
     def spend_vaults(self, vaults, destinations, feerate, priority=False):
         """
         Spend these {vaults} to these {destinations} (mapping of addresses to amounts).
-        Make sure to call this only with revault deployment with a low (<500) CSV, or you'll encounter
-        an ugly timeout from bitcoinlib.
+        This generates CSV blocks, so it takes longer with large timelocks.
 
         :return: the list of spent deposits along with the Spend PSBT.
         """
@@ -703,11 +1228,7 @@ class RevaultNetwork:
         )
 
         self.bitcoind.generate_block(1, wait_for_mempool=[spend_psbt.tx.hash])
-        for w in self.participants():
-            wait_for(
-                lambda: len(w.rpc.listvaults(["spent"], deposits)["vaults"])
-                == len(deposits)
-            )
+        self.wait_for_vaults([(w, ["spent"], deposits) for w in self.participants()])
 
         return deposits, spend_psbt.tx.hash
 
@@ -786,22 +1307,16 @@ class RevaultNetwork:
     def cancel_vault(self, vault):
         deposit = f"{vault['txid']}:{vault['vout']}"
 
-        for w in self.participants():
-            wait_for(
-                lambda: len(
-                    w.rpc.listvaults(
-                        ["unvaulting", "unvaulted", "spending"], [deposit]
-                    )["vaults"]
-                )
-                == 1
-            )
+        self.wait_for_vaults(
+            [
+                (w, ["unvaulting", "unvaulted", "spending"], [deposit])
+                for w in self.participants()
+            ]
+        )
 
         self.stk(0).rpc.revault(deposit)
         self.bitcoind.generate_block(1, wait_for_mempool=1)
-        for w in self.participants():
-            wait_for(
-                lambda: len(w.rpc.listvaults(["canceled"], [deposit])["vaults"]) == 1
-            )
+        self.wait_for_vaults([(w, ["canceled"], [deposit]) for w in self.participants()])
 
     def stop_wallets(self):
         jobs = [self.executor.submit(w.stop) for w in self.participants()]
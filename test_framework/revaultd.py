@@ -1,15 +1,301 @@
+import asyncio
+import collections
 import logging
 import os
+import threading
+import time
 
 from test_framework.utils import (
+    AsyncUnixDomainSocketRpc,
     TailableProc,
+    TIMEOUT,
     VERBOSE,
     UnixDomainSocketRpc,
     LOG_LEVEL,
-    wait_for,
+    NOTIFIER,
     REVAULTD_PATH,
+    scaled_interval,
 )
 
+# The events parsed from revaultd's logs, keyed by deposit outpoint or by txid
+REVAULTD_EVENTS = [
+    ("deposit_seen", r"Got a new unconfirmed deposit at (?P<key>[0-9a-f]{64}:\d+)"),
+    ("vault_confirmed", r"Vault at (?P<key>[0-9a-f]{64}:\d+).* is now confirmed"),
+    ("spend_broadcast", r"Succesfully broadcasted Spend tx '(?P<key>[0-9a-f]{64})'"),
+    # The Unvaults are broadcast by batch, with the list of their txids
+    ("unvault_broadcast", r"Broadcasting Unvault transactions?.*?'(?P<keys>[^']*)'"),
+    ("revault", r"Broadcasting Cancel transaction.*?'(?P<key>[0-9a-f]{64}(?::\d+)?)'"),
+]
+
+
+class VaultsMirror:
+    """An in-memory copy of the vaults of a revaultd, kept up to date by a background
+    thread.
+
+    The thread only polls listvaults while someone is waiting on, or subscribed to,
+    the mirror. Concurrent waiters share the same listvaults calls, which are only
+    for the outpoints they wait on unless one of them needs all the vaults.
+    """
+
+    def __init__(self, rpc, name, interval=0.5):
+        self.rpc = rpc
+        self.name = name
+        # How long to sleep between two polls when no fresh state was requested
+        self.interval = interval
+
+        self.cond = threading.Condition()
+        # Deposit outpoint -> listvaults entry
+        self.vaults = {}
+        # Called with (outpoint, previous status, new vault entry) on each transition
+        self.subscribers = []
+        self.last_error = None
+
+        self._thread = None
+        self._stopped = False
+        self._waiters = 0
+        # The number of waiters on each outpoint, and of those on all the vaults
+        self._waited_outpoints = collections.Counter()
+        self._unfiltered_waiters = 0
+        # Called after each poll, for the asyncio waiters
+        self._listeners = []
+        self._refresh_requested = False
+        # The number of polls started, and the last one that completed
+        self._round = 0
+        self._generation = 0
+
+    def _ensure_running(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stopped = False
+            self._thread = threading.Thread(
+                target=self._run, name=f"{self.name}-vaults", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(
+                    lambda: self._stopped
+                    or self._refresh_requested
+                    or self._waiters > 0
+                    or len(self.subscribers) > 0
+                )
+                if not self._stopped and not self._refresh_requested:
+                    self.cond.wait_for(
+                        lambda: self._stopped or self._refresh_requested,
+                        self.interval,
+                    )
+                if self._stopped:
+                    return
+                self._refresh_requested = False
+                self._round += 1
+                poll_round = self._round
+                outpoints = None
+                if len(self.subscribers) == 0 and self._unfiltered_waiters == 0:
+                    outpoints = sorted(self._waited_outpoints)
+            self._poll(poll_round, outpoints)
+
+    def _poll(self, poll_round, outpoints=None):
+        """Fetch the vaults, only those at {outpoints} if not None"""
+        try:
+            if outpoints is None:
+                vaults = self.rpc.listvaults()["vaults"]
+            elif len(outpoints) > 0:
+                vaults = self.rpc.listvaults([], outpoints)["vaults"]
+            else:
+                vaults = []
+        except Exception as e:
+            # The daemon may be restarting, retry on the next round
+            logging.debug(f"{self.name}: error polling vaults: '{e}'")
+            with self.cond:
+                self.last_error = e
+            return
+
+        index = {f"{v['txid']}:{v['vout']}": v for v in vaults}
+        with self.cond:
+            transitions = []
+            for outpoint, vault in index.items():
+                prev_status = self.vaults.get(outpoint, {}).get("status")
+                if prev_status != vault["status"]:
+                    transitions.append((outpoint, prev_status, vault))
+            if outpoints is None:
+                self.vaults = index
+            else:
+                for outpoint in outpoints:
+                    if outpoint in index:
+                        self.vaults[outpoint] = index[outpoint]
+                    else:
+                        self.vaults.pop(outpoint, None)
+            self.last_error = None
+            self._generation = poll_round
+            self.cond.notify_all()
+            for listener in self._listeners:
+                listener()
+            subscribers = list(self.subscribers)
+        if len(transitions) > 0:
+            NOTIFIER.notify()
+        for callback in subscribers:
+            for transition in transitions:
+                try:
+                    callback(*transition)
+                except Exception as e:
+                    logging.error(f"{self.name}: error in vaults subscriber: '{e}'")
+
+    def subscribe(self, callback):
+        """Get {callback} called with (outpoint, previous status, vault) for each
+        vault status change. The previous status is None for new vaults."""
+        with self.cond:
+            self.subscribers.append(callback)
+            self._ensure_running()
+            self.cond.notify_all()
+
+    def unsubscribe(self, callback):
+        with self.cond:
+            self.subscribers.remove(callback)
+
+    def snapshot(self):
+        """The last known vaults, by deposit outpoint"""
+        with self.cond:
+            return dict(self.vaults)
+
+    def status(self, outpoint):
+        """The last known status of the vault at {outpoint}, None if unknown"""
+        with self.cond:
+            return self.vaults.get(outpoint, {}).get("status")
+
+    def derivation_index(self, outpoint):
+        """The derivation index of the vault at {outpoint}, None if unknown"""
+        with self.cond:
+            return self.vaults.get(outpoint, {}).get("derivation_index")
+
+    def _add_waiter(self, outpoints):
+        """Register a waiter, on the vaults at {outpoints} or on all of them if None.
+        Returns the poll round from which states are fresh enough for it. Must be
+        called with the lock held."""
+        self._ensure_running()
+        self._waiters += 1
+        if outpoints is None:
+            self._unfiltered_waiters += 1
+        else:
+            self._waited_outpoints.update(outpoints)
+        self._refresh_requested = True
+        self.cond.notify_all()
+        return self._round + 1
+
+    def _remove_waiter(self, outpoints):
+        self._waiters -= 1
+        if outpoints is None:
+            self._unfiltered_waiters -= 1
+        else:
+            for outpoint in outpoints:
+                self._waited_outpoints[outpoint] -= 1
+                if self._waited_outpoints[outpoint] == 0:
+                    del self._waited_outpoints[outpoint]
+
+    def _timeout_error(self):
+        msg = f"{self.name}: timed out waiting for vaults"
+        if self.last_error is not None:
+            msg += f" (last error: '{self.last_error}')"
+        return TimeoutError(msg)
+
+    def wait_for(self, predicate, timeout=TIMEOUT, outpoints=None):
+        """Wait for {predicate} to be true of the vaults, by deposit outpoint.
+
+        Only states fetched after this call are considered. If {outpoints} is set,
+        the {predicate} only looks at the vaults at these outpoints: the others may
+        not be fetched.
+        """
+        VaultsMirror.wait_for_all([(self, predicate, outpoints)], timeout)
+
+    def _wait_registered(self, predicate, target, deadline):
+        """Wait for {predicate} as a waiter registered for the poll round {target}.
+        Must be called with the lock held."""
+        while self._generation < target or not predicate(self.vaults):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise self._timeout_error()
+            self.cond.wait(remaining)
+
+    @staticmethod
+    def wait_for_all(waits, timeout=TIMEOUT):
+        """Wait for all these (mirror, predicate, outpoints) {waits}, see wait_for().
+
+        The waiters are registered on all the mirrors before blocking on any of
+        them, so that they all poll concurrently within the same {timeout}.
+        """
+        deadline = time.monotonic() + timeout
+        registered = []
+        try:
+            for mirror, predicate, outpoints in waits:
+                with mirror.cond:
+                    target = mirror._add_waiter(outpoints)
+                registered.append((mirror, predicate, outpoints, target))
+            for mirror, predicate, _, target in registered:
+                with mirror.cond:
+                    mirror._wait_registered(predicate, target, deadline)
+        finally:
+            for mirror, _, outpoints, _ in registered:
+                with mirror.cond:
+                    mirror._remove_waiter(outpoints)
+
+    async def wait_for_async(self, predicate, timeout=TIMEOUT, outpoints=None):
+        """Same as wait_for, from an event loop"""
+        loop = asyncio.get_running_loop()
+        updated = asyncio.Event()
+
+        def listener():
+            loop.call_soon_threadsafe(updated.set)
+
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            self._listeners.append(listener)
+            target = self._add_waiter(outpoints)
+        try:
+            while True:
+                with self.cond:
+                    if self._generation >= target and predicate(self.vaults):
+                        return
+                    # Any poll from now on sets it again
+                    updated.clear()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise self._timeout_error()
+                try:
+                    await asyncio.wait_for(updated.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self.cond:
+                self._listeners.remove(listener)
+                self._remove_waiter(outpoints)
+
+    def _statuses_predicate(self, statuses, outpoints):
+        assert isinstance(outpoints, list)
+        return lambda vaults: all(
+            vaults.get(o, {}).get("status") in statuses for o in outpoints
+        )
+
+    def wait_for_statuses(self, statuses, outpoints, timeout=TIMEOUT):
+        """Wait for all the vaults at {outpoints} to be in one of these {statuses}"""
+        self.wait_for(
+            self._statuses_predicate(statuses, outpoints), timeout, outpoints
+        )
+
+    async def wait_for_statuses_async(self, statuses, outpoints, timeout=TIMEOUT):
+        """Same as wait_for_statuses, from an event loop"""
+        await self.wait_for_async(
+            self._statuses_predicate(statuses, outpoints), timeout, outpoints
+        )
+
+    def stop(self):
+        with self.cond:
+            self._stopped = True
+            self.cond.notify_all()
+            thread = self._thread
+            self._thread = None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
 
 class Revaultd(TailableProc):
     def __init__(
@@ -27,7 +313,10 @@ class Revaultd(TailableProc):
         man_config=None,
         wt_process=None,
         cpfp_seed=None,
+        write_files=True,
     ):
+        """If {write_files} is False, the datadir is left untouched. This is for
+        driving an already running revaultd."""
         # set descriptors
         self.cpfp_desc = cpfp_desc
         self.deposit_desc = deposit_desc
@@ -38,16 +327,30 @@ class Revaultd(TailableProc):
 
         self.prefix = os.path.split(datadir)[-1]
         self.watchtower = wt_process
+        self.events.set_patterns(REVAULTD_EVENTS)
 
-        # The data is stored in a per-network directory. We need to create it
-        # in order to write the Noise private key
+        # The data is stored in a per-network directory
         self.datadir_with_network = os.path.join(datadir, "regtest")
-        os.makedirs(self.datadir_with_network, exist_ok=True)
 
         self.conf_file = os.path.join(datadir, "config.toml")
         self.cmd_line = [REVAULTD_PATH, "--conf", f"{self.conf_file}"]
         socket_path = os.path.join(self.datadir_with_network, "revaultd_rpc")
         self.rpc = UnixDomainSocketRpc(socket_path)
+        # The same, for use from an asyncio event loop
+        self.arpc = AsyncUnixDomainSocketRpc(socket_path)
+        # The waits are served from this instead of polling the daemon
+        self.mirror = VaultsMirror(self.rpc, self.prefix)
+
+        if stk_config is not None:
+            self.stk_keychain = stk_config["keychain"]
+        if man_config is not None:
+            self.man_keychain = man_config["keychain"]
+
+        # Attaching to a running daemon, its datadir is already set up
+        if not write_files:
+            return
+        # We need to create it in order to write the Noise private key
+        os.makedirs(self.datadir_with_network, exist_ok=True)
 
         noise_secret_file = os.path.join(self.datadir_with_network, "noise_secret")
         with open(noise_secret_file, "wb") as f:
@@ -66,7 +369,7 @@ class Revaultd(TailableProc):
 
             f.write(f'coordinator_host = "127.0.0.1:{coordinator_port}"\n')
             f.write(f'coordinator_noise_key = "{coordinator_noise_key}"\n')
-            f.write("coordinator_poll_seconds = 1\n")
+            f.write(f"coordinator_poll_seconds = {scaled_interval(1)}\n")
 
             f.write("[scripts_config]\n")
             f.write(f'deposit_descriptor = "{deposit_desc}"\n')
@@ -77,11 +380,10 @@ class Revaultd(TailableProc):
             f.write('network = "regtest"\n')
             f.write(f"cookie_path = '{bitcoind_cookie_path}'\n")
             f.write(f"addr = '127.0.0.1:{bitcoind_rpc_port}'\n")
-            f.write("poll_interval_secs = 1\n")
+            f.write(f"poll_interval_secs = {scaled_interval(1)}\n")
 
             if stk_config is not None:
                 f.write("[stakeholder_config]\n")
-                self.stk_keychain = stk_config["keychain"]
                 f.write(f'xpub = "{self.stk_keychain.get_xpub()}"\n')
                 f.write("watchtowers = [")
                 for wt in stk_config["watchtowers"]:
@@ -94,7 +396,6 @@ class Revaultd(TailableProc):
 
             if man_config is not None:
                 f.write("[manager_config]\n")
-                self.man_keychain = man_config["keychain"]
                 f.write(f'xpub = "{self.man_keychain.get_xpub()}"\n')
                 for cosig in man_config["cosigners"]:
                     f.write("[[manager_config.cosigners]]\n")
@@ -103,33 +404,40 @@ class Revaultd(TailableProc):
 
     def wait_for_deposits(self, outpoints):
         """
-        Polls listvaults until we acknowledge the confirmed vaults at {outpoints}
+        Waits until we acknowledge the confirmed vaults at {outpoints}
         """
-        assert isinstance(outpoints, list)
-        wait_for(
-            lambda: len(self.rpc.listvaults(["funded"], outpoints)["vaults"])
-            == len(outpoints)
-        )
+        self.mirror.wait_for_statuses(["funded"], outpoints)
 
     def wait_for_secured_vaults(self, outpoints):
         """
-        Polls listvaults until we acknowledge the 'secured' :tm: vaults at {outpoints}
+        Waits until we acknowledge the 'secured' :tm: vaults at {outpoints}
         """
-        assert isinstance(outpoints, list)
-        wait_for(
-            lambda: len(self.rpc.listvaults(["secured"], outpoints)["vaults"])
-            == len(outpoints)
-        )
+        self.mirror.wait_for_statuses(["secured"], outpoints)
 
     def wait_for_active_vaults(self, outpoints):
         """
-        Polls listvaults until we acknowledge the active vaults at {outpoints}
+        Waits until we acknowledge the active vaults at {outpoints}
         """
-        assert isinstance(outpoints, list)
-        wait_for(
-            lambda: len(self.rpc.listvaults(["active"], outpoints)["vaults"])
-            == len(outpoints)
-        )
+        self.mirror.wait_for_statuses(["active"], outpoints)
+
+    async def wait_for_vaults_async(self, statuses, outpoints):
+        """
+        Waits from an event loop until all the vaults at {outpoints} are in one of
+        these {statuses}
+        """
+        await self.mirror.wait_for_statuses_async(statuses, outpoints)
+
+    async def wait_for_deposits_async(self, outpoints):
+        """Same as wait_for_deposits, from an event loop"""
+        await self.wait_for_vaults_async(["funded"], outpoints)
+
+    async def wait_for_secured_vaults_async(self, outpoints):
+        """Same as wait_for_secured_vaults, from an event loop"""
+        await self.wait_for_vaults_async(["secured"], outpoints)
+
+    async def wait_for_active_vaults_async(self, outpoints):
+        """Same as wait_for_active_vaults, from an event loop"""
+        await self.wait_for_vaults_async(["active"], outpoints)
 
     def start(self):
         TailableProc.start(self)
@@ -143,6 +451,7 @@ class Revaultd(TailableProc):
         )
 
     def stop(self, timeout=10):
+        self.mirror.stop()
         try:
             self.rpc.stop()
             self.wait_for_logs(
@@ -155,6 +464,8 @@ class Revaultd(TailableProc):
             self.proc.wait(timeout)
         except Exception as e:
             logging.error(f"{self.prefix} : error when calling stop: '{e}'")
+        self.rpc.close()
+        self.arpc.close()
         return TailableProc.stop(self)
 
     def cleanup(self):
@@ -179,6 +490,7 @@ class ManagerRevaultd(Revaultd):
         bitcoind_cookie,
         man_config,
         cpfp_seed,
+        write_files=True,
     ):
         """The wallet daemon for a manager.
         Needs to know all xpubs, and needs to be able to connect to the
@@ -198,6 +510,7 @@ class ManagerRevaultd(Revaultd):
             man_config=man_config,
             wt_process=None,
             cpfp_seed=cpfp_seed,
+            write_files=write_files,
         )
         assert self.man_keychain is not None
 
@@ -216,6 +529,7 @@ class StakeholderRevaultd(Revaultd):
         bitcoind_cookie,
         stk_config,
         wt_process,
+        write_files=True,
     ):
         """The wallet daemon for a stakeholder.
         Needs to know all xpubs, and needs to be able to connect to the
@@ -235,6 +549,7 @@ class StakeholderRevaultd(Revaultd):
             man_config=None,
             wt_process=wt_process,
             cpfp_seed=None,
+            write_files=write_files,
         )
         assert self.stk_keychain is not None
 
@@ -255,6 +570,7 @@ class StkManRevaultd(Revaultd):
         man_config,
         wt_process,
         cpfp_seed,
+        write_files=True,
     ):
         """A revaultd instance that is both stakeholder and manager."""
         super(StkManRevaultd, self).__init__(
@@ -271,4 +587,5 @@ class StkManRevaultd(Revaultd):
             man_config=man_config,
             wt_process=wt_process,
             cpfp_seed=cpfp_seed,
+            write_files=write_files,
         )
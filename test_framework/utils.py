@@ -3,13 +3,16 @@ Lot of the code here is stolen from C-lightning's test suite. This is surely
 Rusty Russell or Christian Decker who wrote most of this (I'd put some sats on
 cdecker), so credits to them ! (MIT licensed)
 """
+import asyncio
 import bip32
 import coincurve
+import collections
 import itertools
 import json
 import logging
 import os
 import re
+import selectors
 import socket
 import subprocess
 import threading
@@ -31,6 +34,11 @@ POSTGRES_HOST = os.getenv("POSTGRES_HOST", "localhost")
 POSTGRES_IS_SETUP = POSTGRES_USER != "" and POSTGRES_PASS != ""
 VERBOSE = os.getenv("VERBOSE", "0") == "1"
 LOG_LEVEL = os.getenv("LOG_LEVEL", "debug")
+# How many lines of each daemon's output to keep in memory. Older ones are read back
+# from the log file.
+LOG_BUFFER_LINES = int(os.getenv("LOG_BUFFER_LINES", 10_000))
+# The maximum number of is_in_log() searches to remember
+LOG_CURSORS_MAX = 1024
 assert LOG_LEVEL in ["trace", "debug", "info", "warn", "error"]
 DEFAULT_REV_PATH = os.path.join(
     os.path.dirname(__file__), "..", "..", "target/debug/revaultd"
@@ -62,29 +70,92 @@ DEFAULT_COSIG_PATH = os.path.join(
 COSIGNERD_PATH = os.getenv("COSIGNERD_PATH", DEFAULT_COSIG_PATH)
 DEFAULT_BITCOIND_PATH = "bitcoind"
 BITCOIND_PATH = os.getenv("BITCOIND_PATH", DEFAULT_BITCOIND_PATH)
+# Get notified of new blocks and transactions by bitcoind through ZMQ, if pyzmq is
+# installed. Disable it if your bitcoind was compiled without ZMQ support.
+BITCOIND_ZMQ = os.getenv("BITCOIND_ZMQ", "1") == "1"
+# How much faster than real time the chain should go. Above 1, bitcoind's clock is
+# mocked to advance by 10 minutes with each generated block, and the daemons poll
+# more often.
+TIME_ACCELERATION = float(os.getenv("TIME_ACCELERATION", 1))
 WT_PLUGINS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "wtplugins")
 
 
 COIN = 10**8
 
 
+# The bounds of the interval between two checks of a wait_for() condition. We check
+# again as soon as we are notified of an event after the minimum interval, and in
+# any case after the maximum one.
+POLL_INTERVAL_MIN = 0.05
+POLL_INTERVAL_MAX = 0.5
+
+
+class Notifier(object):
+    """Signals the waiters that something they may be waiting for happened, such as
+    a new log line, a new block or a vault status change."""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.events = 0
+
+    def notify(self):
+        with self.cond:
+            self.events += 1
+            self.cond.notify_all()
+
+    def wait(self, events, timeout):
+        """Wait for at most {timeout} seconds for an event after the {events}th one.
+        Returns the number of events so far."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.events != events, timeout)
+            return self.events
+
+
+NOTIFIER = Notifier()
+
+
+def scaled_interval(secs):
+    """The polling interval to configure for the daemons instead of {secs} seconds,
+    given the TIME_ACCELERATION. They only take whole seconds, so this never goes
+    below 1 second: intervals that are already that short are not accelerated,
+    only bitcoind's clock is."""
+    return max(1, round(secs / TIME_ACCELERATION))
+
+
 def wait_for(success, timeout=TIMEOUT, debug_fn=None):
     """
     Run success() either until it returns True, or until the timeout is reached.
     debug_fn is logged at each call to success, it can be useful for debugging
     when tests fail.
+
+    success() is checked again each time we are notified of an event, and at least
+    every POLL_INTERVAL_MAX seconds. Returns how long we waited and how many times
+    success() was called.
     """
     start_time = time.time()
-    interval = 0.25
-    while not success() and time.time() < start_time + timeout:
+    interval = POLL_INTERVAL_MIN
+    probes = 0
+    while True:
+        # Any event from now on may have made success() true
+        events = NOTIFIER.events
+        probe_time = time.time()
+        probes += 1
+        if success():
+            break
+        if probe_time > start_time + timeout:
+            raise ValueError("Error waiting for {}", success)
         if debug_fn is not None:
             logging.info(debug_fn())
-        time.sleep(interval)
-        interval *= 2
-        if interval > 5:
-            interval = 5
-    if time.time() > start_time + timeout:
-        raise ValueError("Error waiting for {}", success)
+        # Don't hammer success() on bursts of events
+        time.sleep(max(probe_time + POLL_INTERVAL_MIN - time.time(), 0))
+        NOTIFIER.wait(events, max(probe_time + interval - time.time(), 0))
+        interval = min(interval * 2, POLL_INTERVAL_MAX)
+
+    stats = {"elapsed": time.time() - start_time, "probes": probes}
+    logging.debug(
+        f"Waited {stats['elapsed']:.3f}s for {success} ({stats['probes']} probes)"
+    )
+    return stats
 
 
 class RpcError(ValueError):
@@ -101,13 +172,16 @@ class RpcError(ValueError):
 
 
 class Participant:
-    def __init__(self):
-        self.hd = bip32.BIP32.from_seed(os.urandom(32), network="test")
+    def __init__(self, xpriv=None):
+        if xpriv is None:
+            self.hd = bip32.BIP32.from_seed(os.urandom(32), network="test")
+        else:
+            self.hd = bip32.BIP32.from_xpriv(xpriv)
 
 
 class User(Participant):
-    def __init__(self):
-        super(User, self).__init__()
+    def __init__(self, xpriv=None):
+        super(User, self).__init__(xpriv)
 
     def get_xpub(self):
         return self.hd.get_xpub()
@@ -181,8 +255,8 @@ class User(Participant):
 
 
 class Cosig(Participant):
-    def __init__(self):
-        super(Cosig, self).__init__()
+    def __init__(self, xpriv=None):
+        super(Cosig, self).__init__(xpriv)
         self.static_key_path = "m/0"
 
     def get_static_key(self):
@@ -340,32 +414,161 @@ class UnixSocket(object):
         self.close()
 
 
-class UnixDomainSocketRpc(object):
-    def __init__(self, socket_path, logger=logging):
-        self.socket_path = socket_path
-        self.logger = logger
-        self.next_id = 0
+# Anything up to the next array or object delimiter, or the next unterminated string
+JSON_SKIP = re.compile(rb'(?:[^{}\[\]"]+|"[^"\\]*(?:\\.[^"\\]*)*")*')
+# The (rest of the) content of a JSON string, up to its closing quote if received
+JSON_STRING_END = re.compile(rb'[^"\\]*(?:\\.[^"\\]*)*(")?')
+
+
+class JsonFramer(object):
+    """Splits a stream of bytes into JSON objects.
+
+    As revaultd's responses aren't delimited, we look for the end of each top-level
+    JSON object as bytes are received, and only decode it once it's complete. The
+    bytes received past its end are kept for the next one.
+    """
+
+    def __init__(self, bufsize=2 ** 16):
+        self.buff = bytearray(bufsize)
+        # How many bytes of buff were received
+        self.len = 0
+        # How far we scanned the object at the start of buff, and its state there
+        self.scanned = 0
+        self.depth = 0
+        self.in_string = False
+
+    def _reserve(self, size):
+        while len(self.buff) - self.len < size:
+            self.buff.extend(bytes(len(self.buff)))
+
+    def recv_from(self, sock):
+        """Receive as many bytes as fit in the buffer from this socket."""
+        self._reserve(1)
+        with memoryview(self.buff) as view, view[self.len :] as free:
+            n_read = sock.recv_into(free)
+        if n_read == 0:
+            raise ConnectionResetError("Connection closed by the server")
+        self.len += n_read
+
+    def feed(self, data):
+        """Append these received bytes."""
+        if len(data) == 0:
+            raise ConnectionResetError("Connection closed by the server")
+        self._reserve(len(data))
+        self.buff[self.len : self.len + len(data)] = data
+        self.len += len(data)
+
+    def _find_end(self):
+        """Continue scanning the received bytes for the end of the JSON object at
+        the start of the buffer. Returns its end offset, or None if incomplete."""
+        pos = self.scanned
+        while True:
+            if self.in_string:
+                m = JSON_STRING_END.match(self.buff, pos, self.len)
+                pos = m.end()
+                if m.group(1) is None:
+                    break
+                self.in_string = False
+            else:
+                pos = JSON_SKIP.match(self.buff, pos, self.len).end()
+                if pos == self.len:
+                    break
+                c = self.buff[pos]
+                pos += 1
+                if c == ord('"'):
+                    self.in_string = True
+                elif c in b"{[":
+                    self.depth += 1
+                else:
+                    self.depth -= 1
+                    if self.depth == 0:
+                        return pos
+                    if self.depth < 0:
+                        raise ValueError(f"Malformed JSON response: {self.buff[:pos]}")
+        self.scanned = pos
+        return None
+
+    def pop(self):
+        """Get the next complete JSON object, or None if we need more bytes."""
+        end = self._find_end()
+        if end is None:
+            return None
+
+        obj = json.loads(self.buff[:end])
+        # Keep what we received past this object for the next one
+        rest = self.len - end
+        self.buff[:rest] = self.buff[end : self.len]
+        self.len = rest
+        self.scanned = 0
+        self.depth = 0
+        self.in_string = False
+        return obj
+
 
-    def _writeobj(self, sock, obj):
-        s = json.dumps(obj, ensure_ascii=False)
-        sock.sock.sendall(s.encode())
+class RpcConnection(object):
+    """A persistent connection to a JSON-RPC server listening on a Unix socket."""
 
-    def _readobj(self, sock):
+    def __init__(self, path):
+        self.sock = UnixSocket(path)
+        self.framer = JsonFramer()
+        # Whether it was used for a previous call already
+        self.reused = False
+
+    def close(self):
+        self.sock.close()
+
+    def sendall(self, msg):
+        self.sock.sendall(msg)
+
+    def readobj(self):
         """Read a JSON object"""
-        buff = b""
         while True:
-            n_to_read = max(2048, len(buff))
-            chunk = sock.recv(n_to_read)
-            buff += chunk
-            if len(chunk) != n_to_read:
-                try:
-                    return json.loads(buff)
-                except json.JSONDecodeError:
-                    # There is more to read, continue
-                    # FIXME: this is a workaround for large reads, but we could
-                    # eventually introduce an "end" marker in revaultd's responses,
-                    # such as '\n'.
-                    continue
+            obj = self.framer.pop()
+            if obj is not None:
+                return obj
+            self.framer.recv_from(self.sock.sock)
+
+
+class UnixDomainSocketRpc(object):
+    """A client for revaultd's JSON-RPC interface.
+
+    Connections to the socket are kept open and re-used across calls. This is
+    thread-safe: a connection is only ever used by one call at a time.
+    """
+
+    # How many idle connections we keep around
+    MAX_IDLE_CONNECTIONS = 8
+    # How many requests of a pipeline are in flight at once, each on its own
+    # connection
+    PIPELINE_DEPTH = 16
+
+    def __init__(self, socket_path, logger=logging):
+        self.socket_path = socket_path
+        self.logger = logger
+        self.next_id = itertools.count()
+        self.idle_conns = []
+        self.conns_lock = threading.Lock()
+
+    def _get_conn(self):
+        with self.conns_lock:
+            if len(self.idle_conns) > 0:
+                return self.idle_conns.pop()
+        return RpcConnection(self.socket_path)
+
+    def _put_conn(self, conn):
+        conn.reused = True
+        with self.conns_lock:
+            if len(self.idle_conns) < self.MAX_IDLE_CONNECTIONS:
+                self.idle_conns.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """Close all the idle connections."""
+        with self.conns_lock:
+            for conn in self.idle_conns:
+                conn.close()
+            self.idle_conns = []
 
     def __getattr__(self, name):
         """Intercept any call that is not explicitly defined and call @call.
@@ -387,31 +590,61 @@ class UnixDomainSocketRpc(object):
 
         return wrapper
 
-    # FIXME: support named parameters on the Rust server!
-    def call(self, method, payload=[]):
-        self.logger.debug("Calling %s with payload %r", method, payload)
-
-        # FIXME: we open a new socket for every readobj call...
-        sock = UnixSocket(self.socket_path)
-        msg = json.dumps(
-            {
-                "jsonrpc": "2.0",
-                "id": 0,
-                "method": method,
-                "params": payload,
-            }
-        )
-        sock.sock.send(msg.encode())
-        this_id = self.next_id
-        resp = self._readobj(sock)
-
-        self.logger.debug("Received response for %s call: %r", method, resp)
-        if "id" in resp and resp["id"] != this_id:
-            raise ValueError(
-                "Malformed response, id is not {}: {}.".format(this_id, resp)
-            )
-        sock.close()
+    def _is_stale(self, conn, resps):
+        """Whether this failed connection may have been closed by the server while
+        idle, for instance if it restarted. In this case it didn't get our requests."""
+        if conn.reused and len(resps) == 0 and conn.framer.len == 0:
+            self.logger.debug("Stale connection to %s", self.socket_path)
+            return True
+        return False
+
+    def _send(self, request):
+        """Send this request on a connection, and return the connection."""
+        msg = json.dumps(request).encode()
+        while True:
+            conn = self._get_conn()
+            try:
+                conn.sendall(msg)
+                return conn
+            except OSError:
+                conn.close()
+                if self._is_stale(conn, []):
+                    continue
+                raise
 
+    def _recv(self, request, conn):
+        """Read the response to this {request} sent on {conn}."""
+        while True:
+            try:
+                resp = conn.readobj()
+            except OSError:
+                conn.close()
+                if self._is_stale(conn, []):
+                    conn = self._send(request)
+                    continue
+                raise
+            self._put_conn(conn)
+            return resp
+
+    def _exchange(self, requests):
+        """Send all these requests without waiting for the responses in between, and
+        read the responses. The server answers a connection's requests one at a time,
+        so each request in flight gets its own connection."""
+        resps = []
+        for i in range(0, len(requests), self.PIPELINE_DEPTH):
+            in_flight = []
+            try:
+                for request in requests[i : i + self.PIPELINE_DEPTH]:
+                    in_flight.append((request, self._send(request)))
+                while len(in_flight) > 0:
+                    (request, conn) = in_flight.pop(0)
+                    resps.append(self._recv(request, conn))
+            finally:
+                for _, conn in in_flight:
+                    conn.close()
+        return resps
+
+    def _check_resp(self, method, payload, resp):
         if not isinstance(resp, dict):
             raise ValueError(
                 "Malformed response, response is not a dictionary %s." % resp
@@ -422,6 +655,518 @@ class UnixDomainSocketRpc(object):
             raise ValueError('Malformed response, "result" missing.')
         return resp["result"]
 
+    def _make_requests(self, calls):
+        requests = []
+        for method, payload in calls:
+            self.logger.debug("Calling %s with payload %r", method, payload)
+            requests.append(
+                {
+                    "jsonrpc": "2.0",
+                    "id": next(self.next_id),
+                    "method": method,
+                    "params": payload,
+                }
+            )
+        return requests
+
+    def _get_results(self, calls, requests, resps):
+        resps_by_id = {}
+        for resp in resps:
+            if not isinstance(resp, dict) or "id" not in resp:
+                # Only valid if we could tell which call it's for
+                if len(requests) == 1:
+                    resps_by_id[requests[0]["id"]] = resp
+                    continue
+                raise ValueError("Malformed response, id is missing: {}.".format(resp))
+            resps_by_id[resp["id"]] = resp
+
+        results = []
+        for (method, payload), req in zip(calls, requests):
+            resp = resps_by_id.get(req["id"])
+            if resp is None:
+                raise ValueError(
+                    "Malformed response, no response with id {}: {}.".format(
+                        req["id"], resps
+                    )
+                )
+            self.logger.debug("Received response for %s call: %r", method, resp)
+            results.append(self._check_resp(method, payload, resp))
+        return results
+
+    # FIXME: support named parameters on the Rust server!
+    def call(self, method, payload=[]):
+        return self.pipeline([(method, payload)])[0]
+
+    def pipeline(self, calls):
+        """Send all these (method, payload) {calls} at once, without waiting for the
+        responses in between.
+
+        Returns the results in the same order, or raises the error of the first
+        failed call.
+        """
+        requests = self._make_requests(calls)
+        resps = self._exchange(requests)
+        return self._get_results(calls, requests, resps)
+
+
+class AsyncRpcConnection(object):
+    """A persistent connection to a JSON-RPC server listening on a Unix socket, using
+    asyncio streams."""
+
+    def __init__(self, reader, writer, sock):
+        self.reader = reader
+        self.writer = writer
+        self.sock = sock
+        self.loop = asyncio.get_running_loop()
+        self.framer = JsonFramer()
+        self.reused = False
+
+    @classmethod
+    async def connect(cls, path):
+        # Connect through UnixSocket to work around the socket path length limit.
+        # This doesn't block on a Unix socket.
+        unix_sock = UnixSocket(path)
+        (sock, unix_sock.sock) = (unix_sock.sock, None)
+        sock.setblocking(False)
+        reader, writer = await asyncio.open_unix_connection(sock=sock)
+        return cls(reader, writer, sock)
+
+    def close(self):
+        """Close the connection, from any thread."""
+        if self.loop.is_closed():
+            # The transport can't be closed without its event loop
+            self.sock.close()
+            return
+        try:
+            in_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            in_loop = False
+        if in_loop:
+            self.writer.close()
+        else:
+            self.loop.call_soon_threadsafe(self.writer.close)
+
+    async def sendall(self, msg):
+        self.writer.write(msg)
+        await self.writer.drain()
+
+    async def readobj(self):
+        """Read a JSON object"""
+        while True:
+            obj = self.framer.pop()
+            if obj is not None:
+                return obj
+            self.framer.feed(await self.reader.read(2 ** 16))
+
+
+class AsyncUnixDomainSocketRpc(UnixDomainSocketRpc):
+    """An asyncio client for revaultd's JSON-RPC interface.
+
+    Same as UnixDomainSocketRpc but calls return coroutines, eg
+    `await rpc.listvaults()`. Connections are kept open and re-used across calls
+    made from the same event loop.
+    """
+
+    async def _get_conn(self):
+        loop = asyncio.get_running_loop()
+        with self.conns_lock:
+            # The connections are bound to the event loop they were created on
+            for conn in [c for c in self.idle_conns if c.loop is not loop]:
+                self.idle_conns.remove(conn)
+            if len(self.idle_conns) > 0:
+                return self.idle_conns.pop()
+        return await AsyncRpcConnection.connect(self.socket_path)
+
+    async def _send(self, request):
+        msg = json.dumps(request).encode()
+        while True:
+            conn = await self._get_conn()
+            try:
+                await conn.sendall(msg)
+                return conn
+            except OSError:
+                conn.close()
+                if self._is_stale(conn, []):
+                    continue
+                raise
+
+    async def _recv(self, request, conn):
+        while True:
+            try:
+                resp = await conn.readobj()
+            except OSError:
+                conn.close()
+                if self._is_stale(conn, []):
+                    conn = await self._send(request)
+                    continue
+                raise
+            self._put_conn(conn)
+            return resp
+
+    async def _exchange(self, requests):
+        resps = []
+        for i in range(0, len(requests), self.PIPELINE_DEPTH):
+            in_flight = []
+            try:
+                for request in requests[i : i + self.PIPELINE_DEPTH]:
+                    in_flight.append((request, await self._send(request)))
+                while len(in_flight) > 0:
+                    (request, conn) = in_flight.pop(0)
+                    resps.append(await self._recv(request, conn))
+            finally:
+                for _, conn in in_flight:
+                    conn.close()
+        return resps
+
+    async def call(self, method, payload=[]):
+        return (await self.pipeline([(method, payload)]))[0]
+
+    async def pipeline(self, calls):
+        """Send all these (method, payload) {calls} at once on the same connection,
+        without waiting for the responses in between.
+
+        Returns the results in the same order, or raises the error of the first
+        failed call.
+        """
+        requests = self._make_requests(calls)
+        resps = await self._exchange(requests)
+        return self._get_results(calls, requests, resps)
+
+
+class LogBuffer(object):
+    """The lines of output of a process.
+
+    The last {capacity} lines are kept in memory, and all of them are appended to
+    the log file at {path} as they arrive. Older lines are read back from the file
+    through a sparse index of line offsets, so this can be accessed like a list.
+    """
+
+    # Record the file offset of one line every this many lines
+    INDEX_INTERVAL = 256
+
+    def __init__(self, path=None, capacity=LOG_BUFFER_LINES):
+        self.path = path
+        self.ring = collections.deque(maxlen=capacity)
+        # The number of lines appended so far, and the file offset of the next one
+        self.count = 0
+        self.size = 0
+        self.index = []
+        self.lock = threading.RLock()
+        self.writer = None
+        self.reader = None
+        # The (line number, file offset) of the next line to read from the file,
+        # to avoid seeking on sequential reads
+        self.cursor = None
+
+    def append(self, line):
+        with self.lock:
+            if self.path is not None:
+                if self.writer is None:
+                    # Start from a fresh log file, but don't truncate it on restart
+                    mode = "ab" if self.count > 0 else "wb"
+                    self.writer = open(self.path, mode, buffering=0)
+                if self.count % self.INDEX_INTERVAL == 0:
+                    self.index.append(self.size)
+                data = line.encode("utf-8", errors="replace") + b"\n"
+                self.writer.write(data)
+                self.size += len(data)
+            self.ring.append(line)
+            self.count += 1
+
+    def first_in_memory(self):
+        return self.count - len(self.ring)
+
+    def _read_line(self, n):
+        if self.path is None:
+            raise IndexError(f"Line {n} is not in memory and we have no log file")
+        if self.reader is None:
+            self.reader = open(self.path, "rb")
+        if self.cursor is None or self.cursor[0] != n:
+            line_no = n - n % self.INDEX_INTERVAL
+            self.reader.seek(self.index[line_no // self.INDEX_INTERVAL])
+            for _ in range(n - line_no):
+                self.reader.readline()
+        else:
+            self.reader.seek(self.cursor[1])
+        line = self.reader.readline()
+        self.cursor = (n + 1, self.reader.tell())
+        return line.decode("utf-8").rstrip("\n")
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            return [self[i] for i in range(*n.indices(self.count))]
+        with self.lock:
+            if n < 0:
+                n += self.count
+            if n < 0 or n >= self.count:
+                raise IndexError("Log line index out of range")
+            first = self.first_in_memory()
+            if n >= first:
+                return self.ring[n - first]
+            return self._read_line(n)
+
+    def lines(self, start=0, end=None):
+        """Iterate over the lines from the {start}th one on, up to the {end}th one if
+        set. Without a log file, the lines no longer in memory are skipped."""
+        n = start
+        if self.path is None:
+            n = max(n, self.first_in_memory())
+        while n < (self.count if end is None else end):
+            yield self[n]
+            n += 1
+
+    def __iter__(self):
+        return self.lines()
+
+    def close(self):
+        with self.lock:
+            for f in (self.writer, self.reader):
+                if f is not None:
+                    f.close()
+            self.writer, self.reader, self.cursor = None, None, None
+
+
+class LogMatcher(object):
+    """Matches log lines against a set of regexes, each expected a number of times.
+
+    The {regexs} are either a regex, or a (regex, count) tuple to expect it {count}
+    times. Duplicated regexes are compiled once and counted instead, so each line is
+    only tested against the distinct regexes still expected.
+    """
+
+    def __init__(self, regexs):
+        counts = {}
+        for r in regexs:
+            (r, count) = r if isinstance(r, tuple) else (r, 1)
+            counts[r] = counts.get(r, 0) + count
+        self.regexs = [re.compile(r) for r in counts]
+        self.remaining = list(counts.values())
+        # Most lines match none of the regexes, filter them out in a single search.
+        # Joining them would renumber their groups and break their backreferences,
+        # so only do it for regexes without any group.
+        self.prefilter = None
+        if all(isinstance(r, str) for r in counts) and all(
+            ex.groups == 0 for ex in self.regexs
+        ):
+            try:
+                self.prefilter = re.compile("|".join(f"(?:{r})" for r in counts))
+            except re.error:
+                pass
+
+    def feed(self, line):
+        """Match a line against the first expected regex it matches, if any.
+        Returns True if it matched one."""
+        if self.prefilter is not None and not self.prefilter.search(line):
+            return False
+        for i, ex in enumerate(self.regexs):
+            if self.remaining[i] > 0 and ex.search(line):
+                logging.debug("Found '%s' in logs", ex)
+                self.remaining[i] -= 1
+                return True
+        return False
+
+    def done(self):
+        return all(count == 0 for count in self.remaining)
+
+    def pending(self):
+        """The (regex, count) still expected"""
+        return [(ex, c) for ex, c in zip(self.regexs, self.remaining) if c > 0]
+
+
+# An event parsed from a log line of the process {prefix}, at {time} as seen by us
+LogEvent = collections.namedtuple("LogEvent", ["kind", "key", "time", "prefix", "fields"])
+
+
+class LogEvents(object):
+    """The typed events parsed from the log lines of a process.
+
+    The {patterns} are (kind, regex) tuples. The regex must have either a 'key' named
+    group, or a 'keys' one in which case an event is recorded for each txid it
+    contains. Other named groups are stored in the events' fields. Events are indexed
+    by kind and key.
+    """
+
+    TXID_RE = re.compile(r"[0-9a-f]{64}")
+
+    def __init__(self, patterns=None):
+        self.cond = threading.Condition()
+        # (kind, key) -> events
+        self.by_key = {}
+        # kind -> events
+        self.by_kind = {}
+        self.set_patterns(patterns if patterns is not None else [])
+
+    def set_patterns(self, patterns):
+        self.patterns = [(kind, re.compile(r)) for kind, r in patterns]
+        self.prefilter = None
+        if len(patterns) > 0:
+            # The regexes share group names, which must be unique in a single regex
+            unnamed = [re.sub(r"\(\?P<\w+>", "(?:", r) for _, r in patterns]
+            self.prefilter = re.compile("|".join(f"(?:{r})" for r in unnamed))
+
+    def parse(self, line, prefix):
+        """Record the event(s) in this log {line}, if any. Returns the first one."""
+        if self.prefilter is None or not self.prefilter.search(line):
+            return None
+        for kind, ex in self.patterns:
+            m = ex.search(line)
+            if m is None:
+                continue
+            fields = m.groupdict()
+            if "keys" in fields:
+                keys = self.TXID_RE.findall(fields.pop("keys"))
+            else:
+                keys = [fields.pop("key")]
+            now = time.time()
+            events = [LogEvent(kind, key, now, prefix, dict(fields)) for key in keys]
+            if len(events) == 0:
+                continue
+            with self.cond:
+                for event in events:
+                    self.by_key.setdefault((kind, event.key), []).append(event)
+                    self.by_kind.setdefault(kind, []).append(event)
+                self.cond.notify_all()
+            return events[0]
+        return None
+
+    def get(self, kind, key):
+        """The first event of this {kind} for this {key}, or None"""
+        with self.cond:
+            events = self.by_key.get((kind, key))
+            return events[0] if events else None
+
+    def all(self, kind, key=None):
+        """All the events of this {kind}, only for this {key} if set"""
+        with self.cond:
+            if key is None:
+                return list(self.by_kind.get(kind, []))
+            return list(self.by_key.get((kind, key), []))
+
+    def wait_for(self, kind, key, timeout=TIMEOUT):
+        """Wait for an event of this {kind} for this {key}, and return the first one"""
+        with self.cond:
+            if not self.cond.wait_for(lambda: (kind, key) in self.by_key, timeout):
+                raise TimeoutError(f"No '{kind}' event for '{key}' in logs")
+            return self.by_key[(kind, key)][0]
+
+    def timeline(self, keys):
+        """All the events for any of these {keys}, in order"""
+        with self.cond:
+            events = [
+                e
+                for kind in self.by_kind
+                for key in keys
+                for e in self.by_key.get((kind, key), [])
+            ]
+        return sorted(events, key=lambda e: e.time)
+
+
+class LogTailer(object):
+    """Reads the output of all the TailableProcs from a single thread.
+
+    The stdout and stderr of each process are read as soon as data is available on
+    either, so a process can't stall on a full pipe. Lines are passed to their
+    process in the order they were read.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.selector = None
+        self.thread = None
+        # Processes to start tailing, registered from the tailer thread
+        self.pending = []
+        self.wakeup_r, self.wakeup_w = None, None
+
+    def _ensure_running(self):
+        if self.thread is not None:
+            return
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+        self.thread = threading.Thread(target=self._run, name="log-tailer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, tailable):
+        """Start tailing the stdout and stderr of this {tailable} process"""
+        with self.lock:
+            self._ensure_running()
+            self.pending.append(tailable)
+            os.write(self.wakeup_w, b"\0")
+
+    def _register_pending(self):
+        os.read(self.wakeup_r, 4096)
+        with self.lock:
+            pending, self.pending = self.pending, []
+        for tailable in pending:
+            try:
+                streams = [s for s in (tailable.proc.stdout, tailable.proc.stderr) if s]
+                tailable.open_streams = len(streams)
+                if len(streams) == 0:
+                    tailable.tail_eof()
+                for stream in streams:
+                    os.set_blocking(stream.fileno(), False)
+                    # The partial line read so far
+                    self.selector.register(
+                        stream, selectors.EVENT_READ, (tailable, bytearray())
+                    )
+            except Exception as e:
+                # Don't leave whoever stops it waiting for output we'll never read
+                logging.error(f"Error tailing '{tailable.prefix}': '{e}'")
+                tailable.tail_eof()
+
+    def _read(self, key):
+        stream = key.fileobj
+        tailable, buf = key.data
+        try:
+            data = os.read(stream.fileno(), 65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+
+        if len(data) == 0:
+            if len(buf) > 0:
+                tailable.tail_line(bytes(buf))
+            self.selector.unregister(stream)
+            stream.close()
+            tailable.open_streams -= 1
+            if tailable.open_streams == 0:
+                tailable.tail_eof()
+            return
+
+        buf += data
+        start = 0
+        while True:
+            end = buf.find(b"\n", start)
+            if end < 0:
+                break
+            tailable.tail_line(bytes(buf[start : end + 1]))
+            start = end + 1
+        del buf[:start]
+
+    def _run(self):
+        while True:
+            try:
+                for key, _ in self.selector.select():
+                    if key.fileobj == self.wakeup_r:
+                        self._register_pending()
+                        continue
+                    try:
+                        self._read(key)
+                    except Exception as e:
+                        logging.error(f"Error tailing '{key.data[0].prefix}': '{e}'")
+            except Exception as e:
+                # This thread tails all the processes, it must not die
+                logging.error(f"Error in the log tailer: '{e}'")
+
+
+TAILER = LogTailer()
+
 
 class TailableProc(object):
     """A monitorable process that we can start, stop and tail.
@@ -431,13 +1176,22 @@ class TailableProc(object):
     """
 
     def __init__(self, outputDir=None, verbose=True):
-        self.logs = []
+        self.logs = LogBuffer(
+            os.path.join(outputDir, "log") if outputDir is not None else None
+        )
         self.logs_cond = threading.Condition(threading.RLock())
         self.env = os.environ.copy()
         self.running = False
         self.proc = None
         self.outputDir = outputDir
         self.logsearch_start = 0
+        # (regex, start) -> (next line to search, matching line if found)
+        self.log_cursors = {}
+        # Set the patterns of the events to parse from the logs in inherited classes
+        self.events = LogEvents()
+        # Set once we read all the output of the process
+        self.tail_done = threading.Event()
+        self.open_streams = 0
 
         # Set by inherited classes
         self.cmd_line = []
@@ -460,20 +1214,13 @@ class TailableProc(object):
             stderr=stderr if stderr else subprocess.PIPE,
             env=self.env,
         )
-        self.thread = threading.Thread(target=self.tail)
-        self.thread.daemon = True
-        self.thread.start()
+        self.tail_done.clear()
         self.running = True
-
-    def save_log(self):
-        if self.outputDir:
-            logpath = os.path.join(self.outputDir, "log")
-            with open(logpath, "w") as f:
-                for l in self.logs:
-                    f.write(l + "\n")
+        TAILER.add(self)
 
     def stop(self, timeout=10):
-        self.save_log()
+        # No need to save the logs, the lines are written to the log file as they
+        # arrive
         self.proc.terminate()
 
         # Now give it some time to react to the signal
@@ -483,7 +1230,8 @@ class TailableProc(object):
             self.proc.kill()
             self.proc.wait()
 
-        self.thread.join()
+        self.tail_done.wait()
+        self.logs.close()
 
         return self.proc.returncode
 
@@ -491,40 +1239,57 @@ class TailableProc(object):
         """Kill process without giving it warning."""
         self.proc.kill()
         self.proc.wait()
-        self.thread.join()
-
-    def tail(self):
-        """Tail the stdout of the process and remember it.
-
-        Stores the lines of output produced by the process in
-        self.logs and signals that a new line was read so that it can
-        be picked up by consumers.
-        """
-        out = self.proc.stdout.readline
-        err = self.proc.stderr.readline
-        for line in itertools.chain(iter(out, ""), iter(err, "")):
-            if len(line) == 0:
-                break
-            if self.log_filter(line.decode("utf-8")):
-                continue
-            if self.verbose:
-                logging.debug(f"{self.prefix}: {line.decode().rstrip()}")
-            with self.logs_cond:
-                self.logs.append(str(line.rstrip()))
-                self.logs_cond.notifyAll()
-        self.running = False
-        self.proc.stdout.close()
-        self.proc.stderr.close()
+        self.tail_done.wait()
+        self.logs.close()
+
+    def tail_line(self, line):
+        """Remember a line of output of the process, and signal it so that it can
+        be picked up by consumers. Called by the log tailer."""
+        line = line.decode("utf-8", errors="replace")
+        if self.log_filter(line):
+            return
+        line = line.rstrip()
+        if self.verbose:
+            logging.debug(f"{self.prefix}: {line}")
+        with self.logs_cond:
+            self.logs.append(line)
+            self.logs_cond.notifyAll()
+        self.events.parse(line, self.prefix)
+        NOTIFIER.notify()
+
+    def tail_eof(self):
+        """Called by the log tailer once all the output of the process was read."""
+        with self.logs_cond:
+            self.running = False
+            self.logs_cond.notifyAll()
+        self.tail_done.set()
 
     def is_in_log(self, regex, start=0):
         """Look for `regex` in the logs."""
 
         ex = re.compile(regex)
-        for l in self.logs[start:]:
-            if ex.search(l):
-                logging.debug("Found '%s' in logs", regex)
-                return l
-
+        # Don't search again the lines we already searched for this regex
+        key = (ex, start)
+        with self.logs_cond:
+            (pos, found) = self.log_cursors.get(key, (start, None))
+            end = len(self.logs)
+        if found is None:
+            # Search without holding the lock, as older lines are read back from
+            # disk and the tailer needs it to append new ones.
+            for l in self.logs.lines(pos, end):
+                pos += 1
+                if ex.search(l):
+                    found = l
+                    break
+            with self.logs_cond:
+                if len(self.log_cursors) >= LOG_CURSORS_MAX:
+                    self.log_cursors.clear()
+                if self.log_cursors.get(key, (start, None))[0] < pos:
+                    self.log_cursors[key] = (pos, found)
+
+        if found is not None:
+            logging.debug("Found '%s' in logs", regex)
+            return found
         logging.debug(f"{self.prefix} : Did not find {regex} in logs")
         return None
 
@@ -536,21 +1301,25 @@ class TailableProc(object):
         fail if the timeout is exceeded or if the underlying process
         exits before all the `regexs` were found.
 
+        A regex may be given as a (regex, count) tuple to wait for {count}
+        occurrences of it.
+
         If timeout is None, no time-out is applied.
         """
         logging.debug("Waiting for {} in the logs".format(regexs))
 
-        exs = [re.compile(r) for r in regexs]
+        matcher = LogMatcher(regexs)
         start_time = time.time()
         pos = self.logsearch_start
 
         while True:
             if timeout is not None and time.time() > start_time + timeout:
-                print("Time-out: can't find {} in logs".format(exs))
-                for r in exs:
+                pending = matcher.pending()
+                print("Time-out: can't find {} in logs".format(pending))
+                for r, _ in pending:
                     if self.is_in_log(r):
                         print("({} was previously in logs!)".format(r))
-                raise TimeoutError('Unable to find "{}" in logs.'.format(exs))
+                raise TimeoutError('Unable to find "{}" in logs.'.format(pending))
 
             with self.logs_cond:
                 if pos >= len(self.logs):
@@ -558,16 +1327,14 @@ class TailableProc(object):
                         raise ValueError("Process died while waiting for logs")
                     self.logs_cond.wait(1)
                     continue
+                end = len(self.logs)
 
-                for r in exs.copy():
-                    self.logsearch_start = pos + 1
-                    if r.search(self.logs[pos]):
-                        logging.debug("Found '%s' in logs", r)
-                        exs.remove(r)
-                        break
-                if len(exs) == 0:
-                    return self.logs[pos]
+            # Don't hold the lock while searching, see is_in_log()
+            for line in self.logs.lines(pos, end):
                 pos += 1
+                self.logsearch_start = pos
+                if matcher.feed(line) and matcher.done():
+                    return line
 
     def wait_for_log(self, regex, timeout=TIMEOUT):
         """Look for `regex` in the logs.